@@ -0,0 +1,249 @@
+'''
+Append-only archive of every forecast we parse, to see how the forecast for
+a day evolved and how accurate it was. The caches only keep the latest one.
+
+Rows go to an SQLite database (outside the cache directory, so they're never
+evicted) in batches, one transaction per `BATCH_ROWS` rows. Nothing is
+written outside those transactions, so the database is only locked while a
+batch is written and other processes archiving meanwhile (e.g. `--watch`
+and the cards) don't wait for each other. Each payload is archived once, by its SHA-1, with the time it was fetched as its issue time.
+The tables are clustered on (city, target date, ...) so that all forecasts
+of a city for a date are one range scan however many rows there are.
+'''
+from columns import MISSING, TIMESLOTS, VALUE_COLUMNS
+
+import atexit
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from typing import Iterable, List, Tuple
+
+ARCHIVE_PATH = os.path.join(tempfile.gettempdir(), 'bbc_weather_archive.sqlite3')
+# rows buffered before they're written in one transaction
+BATCH_ROWS = 5000
+
+# `lead_sec` is how long before the target (midnight, or the hour) it was issued
+ArchivedDay = namedtuple('ArchivedDay', ['city_id', 'issued', 'target', 'description',
+                                         'temp_low', 'temp_high', 'lead_sec'])
+ArchivedHour = namedtuple('ArchivedHour', ['city_id', 'issued', 'target', 'timeslot', 'description',
+                                           'temperature', 'precipitation', 'humidity', 'wind', 'lead_sec'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    city_id INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    issued INTEGER NOT NULL,
+    PRIMARY KEY (city_id, source, digest)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS daily (
+    city_id INTEGER NOT NULL,
+    target TEXT NOT NULL,
+    issued INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    text_id INTEGER,
+    temp_low INTEGER,
+    temp_high INTEGER,
+    PRIMARY KEY (city_id, target, issued DESC, source)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hourly (
+    city_id INTEGER NOT NULL,
+    target TEXT NOT NULL,
+    minutes INTEGER NOT NULL,
+    issued INTEGER NOT NULL,
+    text_id INTEGER,
+    temperature INTEGER,
+    precipitation INTEGER,
+    humidity INTEGER,
+    wind INTEGER,
+    PRIMARY KEY (city_id, target, minutes, issued DESC)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS snapshots_issued ON snapshots (city_id, issued);
+'''
+
+
+def _target_time(date, minutes=0) -> float:
+    return time.mktime(time.strptime(date, '%Y-%m-%d')) + minutes * 60
+
+
+class ForecastArchive:
+    '''
+    Buffers archived rows in memory and writes them in batches. Safe to
+    share between threads; call `flush` (done at exit) to write what's left.
+    '''
+    def __init__(self, path=ARCHIVE_PATH, batch_rows=BATCH_ROWS):
+        self.path = path
+        self.batch_rows = batch_rows
+        self._db = None
+        self._lock = threading.RLock()
+        self._snapshots, self._daily, self._hourly = [], [], []
+        # snapshot keys archived (or buffered) already
+        self._seen = set()
+        # text -> id of the texts in the database, buffered rows hold the texts
+        self._texts = {}
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+            self._texts = {text: i for i, text in self._db.execute('SELECT id, text FROM texts')}
+        return self._db
+
+    def _text_ids(self, db):
+        '''Add the texts of the buffered rows that aren't in the database yet. Inside `flush`'s transaction.'''
+        new = {row[4] for row in self._daily} | {row[4] for row in self._hourly}
+        new -= self._texts.keys()
+        new.discard(None)
+        if not new:
+            return
+        db.executemany('INSERT OR IGNORE INTO texts (text) VALUES (?)', [(text,) for text in new])
+        for text in new:
+            self._texts[text] = db.execute('SELECT id FROM texts WHERE text = ?', (text,)).fetchone()[0]
+
+    def _is_new(self, city_id, source, digest) -> bool:
+        key = (int(city_id), source, bytes.fromhex(digest))
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        found = self._connect().execute('SELECT 1 FROM snapshots WHERE city_id = ? AND source = ? AND digest = ?',
+                                        key).fetchone()
+        return found is None
+
+    def record(self, city_id, issued, digest, days: Iterable[Tuple] = (), hours=None, source='api') -> bool:
+        '''
+        Archive what was parsed out of one payload, unless it was archived
+        already. `days` are (date, description, low, high) rows like
+        `hourly.DaySummary` and `hours` a `columns.HourlyColumns`.
+        '''
+        if digest is None:
+            return False
+        # not imported until something's archived, most runs only read the caches
+        import sqlite3
+        with self._lock:
+            try:
+                if not self._is_new(city_id, source, digest):
+                    return False
+                city_id, issued = int(city_id), int(issued)
+                self._snapshots.append((city_id, source, bytes.fromhex(digest), issued))
+                for date, description, low, high in days:
+                    self._daily.append((city_id, date, issued, source, description, low, high))
+                if hours:
+                    for date, (start, stop) in hours.bounds.items():
+                        rows = zip(hours.minutes[start:stop], hours.types[start:stop],
+                                   *(getattr(hours, name)[start:stop] for name in VALUE_COLUMNS))
+                        for minutes, itext, *values in rows:
+                            self._hourly.append((city_id, date, minutes, issued, hours.texts[itext],
+                                                 *(None if v == MISSING else v for v in values)))
+                if len(self._daily) + len(self._hourly) >= self.batch_rows:
+                    self.flush()
+            except (sqlite3.Error, ValueError) as e:
+                # the forecast itself is fine, what's buffered is written next time
+                print(f"Failed to archive the forecast of {city_id}: {e}", file=sys.stderr)
+                return False
+        return True
+
+    def flush(self) -> bool:
+        '''
+        Write the buffered rows in one transaction. If the database can't be
+        written (e.g. it's locked for longer than sqlite's timeout) they stay
+        buffered for the next try and this returns False.
+        '''
+        import sqlite3
+        with self._lock:
+            if not self._snapshots:
+                return True
+            texts = dict(self._texts)
+            try:
+                db = self._connect()
+                with db:
+                    self._text_ids(db)
+                    db.executemany('INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?, ?)', self._snapshots)
+                    db.executemany('INSERT OR IGNORE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [row[:4] + (self._texts.get(row[4]),) + row[5:] for row in self._daily])
+                    db.executemany('INSERT OR IGNORE INTO hourly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [row[:4] + (self._texts.get(row[4]),) + row[5:] for row in self._hourly])
+            except sqlite3.Error as e:
+                # the texts inserted in the rolled back transaction aren't there
+                self._texts = texts
+                print(f"Failed to write the forecast archive: {e}", file=sys.stderr)
+                return False
+            self._snapshots, self._daily, self._hourly = [], [], []
+            return True
+
+    def daily_forecasts(self, city_id, date) -> List[ArchivedDay]:
+        '''Every forecast of a city for a date, shortest lead time first.'''
+        self.flush()
+        rows = self._connect().execute(
+            'SELECT d.city_id, d.issued, d.target, t.text, d.temp_low, d.temp_high FROM daily d '
+            'LEFT JOIN texts t ON t.id = d.text_id '
+            'WHERE d.city_id = ? AND d.target = ? ORDER BY d.issued DESC', (int(city_id), date))
+        target = _target_time(date)
+        return [ArchivedDay(*row, target - row[1]) for row in rows]
+
+    def hourly_forecasts(self, city_id, date, timeslot=None) -> List[ArchivedHour]:
+        '''
+        Every hourly forecast of a city for a date (or just one "HH:MM" of it)
+        by hour, shortest lead time first.
+        '''
+        self.flush()
+        query = ('SELECT h.city_id, h.issued, h.target, h.minutes, t.text, h.temperature, h.precipitation, '
+                 'h.humidity, h.wind FROM hourly h LEFT JOIN texts t ON t.id = h.text_id '
+                 'WHERE h.city_id = ? AND h.target = ?')
+        params = [int(city_id), date]
+        if timeslot is not None:
+            hours, minutes = timeslot.split(':')
+            query += ' AND h.minutes = ?'
+            params.append(int(hours) * 60 + int(minutes))
+        query += ' ORDER BY h.minutes, h.issued DESC'
+        target = _target_time(date)
+        return [ArchivedHour(city_id, issued, target_date, TIMESLOTS[m], *values,
+                             target + m * 60 - issued)
+                for city_id, issued, target_date, m, *values in self._connect().execute(query, params)]
+
+    def issues(self, city_id) -> List[Tuple[int, str]]:
+        '''(issue time, source) of every archived snapshot of a city, oldest first.'''
+        self.flush()
+        return self._connect().execute('SELECT issued, source FROM snapshots WHERE city_id = ? ORDER BY issued',
+                                       (int(city_id),)).fetchall()
+
+    def close(self):
+        import sqlite3
+        with self._lock:
+            self.flush()
+            if self._db is not None:
+                try:
+                    self._db.close()
+                except sqlite3.Error:
+                    pass
+                self._db = None
+
+
+archive = ForecastArchive()
+atexit.register(archive.close)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="How the archived forecasts of a day evolved")
+    parser.add_argument('city_id', type=int)
+    parser.add_argument('date', help="YYYY-MM-DD")
+    parser.add_argument('timeslot', nargs='?', help="HH:MM, to show the hourly forecasts of that hour")
+    args = parser.parse_args()
+    if args.timeslot:
+        for f in archive.hourly_forecasts(args.city_id, args.date, args.timeslot):
+            print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(f.issued))} ({f.lead_sec / 3600:5.1f} h ahead)"
+                  f" \t {f.temperature} °C \t {f.precipitation} % \t {f.description}")
+    else:
+        for f in archive.daily_forecasts(args.city_id, args.date):
+            print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(f.issued))} ({f.lead_sec / 86400:4.1f} d ahead)"
+                  f" \t {f.temp_low} to {f.temp_high} °C \t {f.description}")
@@ -0,0 +1,140 @@
+from hourly import request_aggregated
+from daily import daily_from_summaries, scrape, id2page
+from transport import make_session
+from utils import get_city_id
+
+import asyncio
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Union
+
+# Everything fetched for one city. `error` is the exception if the fetch failed
+CityForecast = namedtuple('CityForecast', ['city_id', 'daily', 'hourly', 'error'])
+
+DEFAULT_CONCURRENCY = 8
+
+
+def fetch_city(city_id, session=None, use_emojis=True) -> CityForecast:
+    '''
+    Daily and hourly data of a city from one aggregated API payload. Goes
+    through the same tempdir caches as the interactive app, so a cached city
+    costs no network time.
+    '''
+    aggregated = request_aggregated(city_id, session)
+    if not aggregated:
+        return CityForecast(city_id, scrape(id2page(city_id), use_emojis, session=session), {}, None)
+    daily = daily_from_summaries(aggregated[0], use_emojis)
+    if not daily:
+        daily = scrape(id2page(city_id), use_emojis, session=session)
+    return CityForecast(city_id, daily, aggregated[1], None)
+
+
+async def afetch_many(city_ids, concurrency=DEFAULT_CONCURRENCY, session=None,
+                      use_emojis=True) -> AsyncIterator[CityForecast]:
+    '''
+    Fetch many cities at once, at most `concurrency` in flight, and yield
+    each one as soon as it's done. The blocking requests run in a thread pool
+    sharing one pooled session. `city_ids` is consumed lazily and a city is
+    only started once an earlier one has been taken, so however many cities
+    there are at most `concurrency` forecasts are held at a time. Failed
+    `CityForecast`s among `city_ids` (see `iter_city_list`) are passed on.
+    '''
+    own_session = session is None
+    if own_session:
+        session = make_session(concurrency)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def fetch_one(city_id):
+        try:
+            return await loop.run_in_executor(executor, fetch_city, city_id, session, use_emojis)
+        except Exception as e:
+            return CityForecast(city_id, [], {}, e)
+
+    pending = set()
+    city_ids = iter(city_ids)
+    try:
+        while True:
+            for city_id in city_ids:
+                if isinstance(city_id, CityForecast):
+                    yield city_id
+                    continue
+                pending.add(asyncio.ensure_future(fetch_one(city_id)))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if own_session:
+            session.close()
+
+
+def fetch_many(city_ids, concurrency=DEFAULT_CONCURRENCY, session=None,
+               use_emojis=True, workers=0) -> Iterator[CityForecast]:
+    '''
+    Blocking version of `afetch_many`, e.g.
+        for city in fetch_many([2643743, 2988507]):
+            print(city.city_id, city.daily[0])
+    With `workers` the payloads are parsed by that many processes instead,
+    see `parse_pool.fetch_many`.
+    '''
+    if workers:
+        from parse_pool import fetch_many as fetch_many_parsing
+        yield from fetch_many_parsing(city_ids, workers, concurrency, session, use_emojis)
+        return
+    loop = asyncio.new_event_loop()
+    results = afetch_many(city_ids, concurrency, session, use_emojis)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
+
+
+def iter_city_list(file_path) -> Iterator[Union[int, CityForecast]]:
+    '''
+    One city per line, either a BBC city id or a name to fuzzy match against
+    city_ids.dat. Blank lines and lines starting with # are skipped. A name
+    that can't be matched is yielded as a failed `CityForecast` of the line,
+    which `fetch_many` passes on to be reported like any other failed city.
+    '''
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                yield int(line) if line.isdigit() else get_city_id(line)
+            except (KeyError, ValueError) as e:
+                yield CityForecast(line, [], {}, e)
+
+
+def read_city_list(file_path) -> List[int]:
+    '''The ids of `iter_city_list`, the lines that can't be matched are reported and skipped.'''
+    city_ids = []
+    for city_id in iter_city_list(file_path):
+        if isinstance(city_id, CityForecast):
+            print(f"{city_id.city_id}: ERROR {city_id.error}", file=sys.stderr)
+        else:
+            city_ids.append(city_id)
+    return city_ids
+
+
+def print_batch(file_path, concurrency=DEFAULT_CONCURRENCY, workers=0):
+    for city in fetch_many(iter_city_list(file_path), concurrency, workers=workers):
+        if city.error:
+            print(f"{city.city_id}: ERROR {city.error}")
+            continue
+        for weather in city.daily:
+            print(f"{city.city_id}\t{weather.date}\t{weather.temp_low} to {weather.temp_high} °C\t{weather.descr}")
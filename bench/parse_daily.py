@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+'''
+Compare the streaming `daylink-*` extractor against the full-DOM BeautifulSoup
+parse on saved BBC daily pages (gzipped or not), by default the benchmark
+fixture, e.g.
+
+    python bench/parse_daily.py /tmp/2643743.html
+'''
+import gzip
+import os
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from daily import extract_days, extract_days_soup
+
+DEFAULT_PAGE = os.path.join(BENCH_DIR, 'fixtures', 'daily.html.gz')
+
+
+def measure(func, path, repeat=5):
+    '''Best wall time in ms and peak traced memory in KiB, including the file read.'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = func(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best * 1e3, peak / 1024
+
+
+def open_page(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def parse_streaming(path):
+    with open_page(path) as f:
+        return extract_days(f)
+
+
+def parse_soup(path):
+    with open_page(path) as f:
+        return extract_days_soup(f.read())
+
+
+if __name__ == '__main__':
+    print(f"{'file':<30} {'parser':<10} {'time (ms)':>10} {'peak (KiB)':>11}")
+    for path in sys.argv[1:] or [DEFAULT_PAGE]:
+        fast, fast_ms, fast_kib = measure(parse_streaming, path)
+        slow, slow_ms, slow_kib = measure(parse_soup, path)
+        name = os.path.basename(path)
+        print(f"{name:<30} {'stream':<10} {fast_ms:>10.2f} {fast_kib:>11.1f}")
+        print(f"{name:<30} {'soup':<10} {slow_ms:>10.2f} {slow_kib:>11.1f}")
+        if fast != slow:
+            print(f"WARNING: extractors disagree on {path}")
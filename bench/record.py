@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+'''
+Record fresh benchmark fixtures from BBC (needs network access), e.g.
+
+    python bench/record.py 2643743
+'''
+import gzip
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hourly import API_URL, HEADERS
+from daily import PAGE_URL
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def record(city_id, fixtures_dir=FIXTURES_DIR):
+    response = requests.get(API_URL.format(city_id), headers=HEADERS, timeout=10)
+    response.raise_for_status()
+    # validates it too
+    aggregated = response.json()
+    with open(os.path.join(fixtures_dir, 'aggregated.json'), 'w', encoding='utf-8') as f:
+        json.dump(aggregated, f)
+    response = requests.get(PAGE_URL.format(city_id), timeout=10)
+    response.raise_for_status()
+    with gzip.open(os.path.join(fixtures_dir, 'daily.html.gz'), 'wb') as f:
+        f.write(response.content)
+    print(f"Recorded city {city_id} in {fixtures_dir}")
+
+
+if __name__ == '__main__':
+    record(sys.argv[1] if len(sys.argv) > 1 else '2643743')
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''
+Offline benchmarks: BBC and ipinfo.io are replaced by bench/stub_server.py
+replaying the fixtures, with a private cache directory and archive, so runs
+are repeatable and don't touch the app's caches. Results are JSON, e.g.
+
+    python bench/run.py --output before.json
+    python bench/run.py --latency 0.05 --compare before.json
+    python bench/run.py --only scrape_cold scrape_warm
+'''
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+# city_ids.dat is looked up relative to the working directory
+os.chdir(REPO_DIR)
+
+import archive
+import cache as cache_module
+import closest_city
+import daily
+import hourly
+import transport
+from stub_server import StubServer
+
+CITY_ID = 2643743
+CITY_NAMES = ['London', 'nw yrk', 'thesaloniki', 'Kozani']
+# a result is flagged when it's this much slower than the one compared to
+REGRESSION_RATIO = 1.2
+
+
+def reset_caches():
+    '''Forget everything fetched or parsed, in memory and on disk.'''
+    cache = cache_module.cache
+    with cache._lock:
+        cache._memory.clear()
+        cache._refreshing.clear()
+    shutil.rmtree(cache.directory, ignore_errors=True)
+    os.makedirs(cache.directory)
+    hourly._hourly.clear()
+
+
+def measure(func, setup=None, repeat=20, number=1):
+    '''
+    Time `number` calls of `func` `repeat` times, running `setup` (untimed)
+    before each repeat. Milliseconds per call.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number * 1e3)
+    return {'min_ms': min(times), 'median_ms': statistics.median(times), 'mean_ms': statistics.mean(times),
+            'stdev_ms': statistics.stdev(times) if len(times) > 1 else 0.0, 'repeat': repeat, 'number': number}
+
+
+def warm_page():
+    reset_caches()
+    daily.scrape(daily.id2page(CITY_ID))
+
+
+def warm_aggregated():
+    reset_caches()
+    hourly.request_hourly(CITY_ID)
+
+
+def bench_scrape_cold():
+    return measure(lambda: daily.scrape(daily.id2page(CITY_ID)), setup=reset_caches, repeat=10)
+
+
+def bench_scrape_warm():
+    warm_page()
+    return measure(lambda: daily.scrape(daily.id2page(CITY_ID)), number=20)
+
+
+def bench_request_hourly_cold():
+    return measure(lambda: hourly.request_hourly(CITY_ID), setup=reset_caches, repeat=10)
+
+
+def bench_request_hourly_warm():
+    warm_aggregated()
+    return measure(lambda: hourly.request_hourly(CITY_ID), number=20)
+
+
+def bench_get_daily_cold():
+    return measure(lambda: daily.get_daily(CITY_ID), setup=reset_caches, repeat=10)
+
+
+def bench_fmt_day_hourly():
+    '''Loading (from the warm cache) and formatting a day, without the in-memory memo.'''
+    warm_aggregated()
+    return measure(lambda: hourly.fmt_day_hourly(CITY_ID, 1), setup=hourly._hourly.clear, repeat=50)
+
+
+def bench_fmt_day_hourly_memoized():
+    warm_aggregated()
+    hourly.fmt_day_hourly(CITY_ID, 1)
+    return measure(lambda: hourly.fmt_day_hourly(CITY_ID, 1), number=1000)
+
+
+def bench_get_city_id():
+    from utils import get_city_id
+    return measure(lambda: [get_city_id(name) for name in CITY_NAMES], number=20)
+
+
+def bench_find_closest_city():
+    out = io.StringIO()
+
+    def find():
+        with contextlib.redirect_stdout(out):
+            closest_city.find_closest_city()
+    # the first call builds the index
+    find()
+    return measure(find, repeat=10)
+
+
+def bench_get_weather_emoji():
+    from weather_icons import get_weather_emoji
+    descriptions = [s.description for s in hourly.summary_from_aggregated(json.loads(STUB.aggregated))]
+    descriptions += list(hourly.hourly_from_aggregated(json.loads(STUB.aggregated)).texts)
+    return measure(lambda: [get_weather_emoji(d) for d in descriptions], number=100)
+
+
+def card_renderer(out):
+    from render import CardRenderer
+    import scraper
+    warm_aggregated()
+    return CardRenderer('London', daily.get_daily(CITY_ID), scraper.format_keys(), out=out)
+
+
+def bench_card_draw():
+    out = io.StringIO()
+    renderer = card_renderer(out)
+
+    def draw():
+        renderer.draw(0)
+        out.seek(0)
+        out.truncate()
+    return measure(draw, number=20)
+
+
+def bench_card_update():
+    out = io.StringIO()
+    renderer = card_renderer(out)
+    renderer.draw(0)
+    # what the 's' key does: the highlight moves to the next row
+    moves = itertools.cycle([4, 0])
+
+    def update():
+        renderer.update(next(moves))
+        out.seek(0)
+        out.truncate()
+    return measure(update, number=100)
+
+
+BENCHMARKS = {
+    'scrape_cold': bench_scrape_cold,
+    'scrape_warm': bench_scrape_warm,
+    'request_hourly_cold': bench_request_hourly_cold,
+    'request_hourly_warm': bench_request_hourly_warm,
+    'get_daily_cold': bench_get_daily_cold,
+    'fmt_day_hourly': bench_fmt_day_hourly,
+    'fmt_day_hourly_memoized': bench_fmt_day_hourly_memoized,
+    'get_city_id': bench_get_city_id,
+    'find_closest_city': bench_find_closest_city,
+    'get_weather_emoji': bench_get_weather_emoji,
+    'card_draw': bench_card_draw,
+    'card_update': bench_card_update,
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    '''Print how each benchmark's median compares to the same one in another results file.'''
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    print(f"{'benchmark':<26} {'before (ms)':>12} {'after (ms)':>12} {'ratio':>7}", file=sys.stderr)
+    for name, result in results.items():
+        before = baseline.get(name, {})
+        if 'median_ms' not in result or 'median_ms' not in before:
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+        flag = '  <- slower' if ratio > REGRESSION_RATIO else ''
+        print(f"{name:<26} {before['median_ms']:>12.3f} {result['median_ms']:>12.3f} {ratio:>7.2f}{flag}",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks and print the results as JSON")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds the stub server waits per response")
+    parser.add_argument('--only', nargs='+', metavar='NAME', help=f"run only these of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    parser.add_argument('--compare', metavar='FILE', help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    STUB = StubServer(latency=args.latency).start()
+    hourly.API_URL = STUB.url + '/aggregated/{}'
+    daily.PAGE_URL = STUB.url + '/weather/{}'
+    closest_city.LOCATION_URL = STUB.url + '/location'
+    workdir = tempfile.mkdtemp(prefix='bbc_weather_bench_')
+    cache_module.cache.directory = os.path.join(workdir, 'cache')
+    archive.archive.path = os.path.join(workdir, 'archive.sqlite3')
+    reset_caches()
+
+    results = {}
+    try:
+        for name, bench in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            try:
+                results[name] = bench()
+            except ImportError as e:
+                results[name] = {'skipped': f"missing dependency: {str(e).splitlines()[0]}"}
+            print(f"{name}: {results[name]}", file=sys.stderr)
+    finally:
+        archive.archive.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency_sec': args.latency,
+        'results': results,
+        'latency_by_host': transport.latency_percentiles(),
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for BBC's API and pages and for ipinfo.io, replaying the
+fixtures in bench/fixtures with a configurable latency, e.g.
+
+    python bench/stub_server.py --port 8765 --latency 0.1
+
+    GET /aggregated/{city_id}   aggregated forecast JSON, dates moved to start today
+    GET /weather/{city_id}      daily forecast page
+    GET /location               ipinfo.io style {"loc": "lat,lon"}
+    GET /stats                  requests served so far
+
+Responses carry an ETag and If-None-Match gets a 304, like the real thing.
+'''
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# London
+DEFAULT_LOCATION = (51.50853, -0.12574)
+
+
+def load_fixtures(fixtures_dir=FIXTURES_DIR):
+    '''(aggregated JSON, daily page) bodies, the JSON's dates moved so its first day is today.'''
+    with open(os.path.join(fixtures_dir, 'aggregated.json'), encoding='utf-8') as f:
+        aggregated = f.read()
+    first = datetime.date.fromisoformat(json.loads(aggregated)['forecasts'][0]['summary']['report']['localDate'])
+    shift = datetime.date.today() - first
+
+    def move(match):
+        return (datetime.date.fromisoformat(match.group(0)) + shift).isoformat()
+
+    aggregated = re.sub(r'\d{4}-\d{2}-\d{2}', move, aggregated)
+    with gzip.open(os.path.join(fixtures_dir, 'daily.html.gz'), 'rb') as f:
+        page = f.read()
+    return aggregated.encode('utf-8'), page
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/aggregated/'):
+            body, content_type = server.aggregated, 'application/json'
+        elif path.startswith('/weather/'):
+            body, content_type = server.page, 'text/html; charset=utf-8'
+        elif path == '/location':
+            body, content_type = json.dumps({'loc': '{},{}'.format(*server.location)}).encode(), 'application/json'
+        elif path == '/stats':
+            body, content_type = json.dumps(server.hits).encode(), 'application/json'
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            server.count('304')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        server.count('200')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.0, location=DEFAULT_LOCATION, fixtures_dir=FIXTURES_DIR):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.location = location
+        self.aggregated, self.page = load_fixtures(fixtures_dir)
+        self.hits = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, status):
+        with self._lock:
+            self.hits[status] += 1
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> 'StubServer':
+        '''Serve in a daemon thread.'''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay the benchmark fixtures like BBC would")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds before every response")
+    args = parser.parse_args()
+    server = StubServer(args.port, args.latency)
+    print(f"Serving fixtures on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
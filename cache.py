@@ -0,0 +1,364 @@
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple, Counter, OrderedDict
+from typing import Optional
+
+from profiling import count, span
+import transport
+
+# One directory for everything we cache so disk eviction never touches other files
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'bbc_weather')
+# total size of the cached files on disk before the least recently used go
+MAX_DISK_BYTES = 32 * 1024 * 1024
+# number of bodies kept in memory
+MAX_MEMORY_ENTRIES = 32
+# how long past its TTL an entry can still be served while it's being refreshed
+MAX_STALE_SEC = 12 * 3600
+META_EXT = '.meta'
+
+# A cached response body, its HTTP validators and the SHA-1 (hex) of the body.
+# `body` is None if it was dropped, see `drop_body`
+Entry = namedtuple('Entry', ['body', 'etag', 'last_modified', 'stored_at', 'digest'])
+
+
+class ForecastCache:
+    '''
+    Two-tier cache of raw forecast payloads: an in-process LRU in front of
+    a size-bounded directory. Every key is a file name, `{key}` holds the
+    body and `{key}.meta` the validators and when it was stored. Files are
+    written atomically and the `.meta` file mtime is the last time a reader
+    used the entry (rewriting the entry keeps it), for LRU eviction on disk
+    and to tell which entries are in demand. Reads inside `quiet()` don't
+    count as uses.
+    '''
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_DISK_BYTES,
+                 max_entries=MAX_MEMORY_ENTRIES, max_stale=MAX_STALE_SEC):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_stale = max_stale
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # keys being revalidated in the background
+        self._refreshing = set()
+        # how many times each key was read by this process
+        self.reads = Counter()
+        # default of `fetch`'s stale_while_revalidate, off for runs that exit
+        # right away and would kill the background refresh
+        self.stale_while_revalidate = True
+        # bytes in `_disk_dir`, kept up to date by our own writes and deletes
+        # so the directory is only scanned once it looks too big (other
+        # processes' writes are only seen then). None until the first scan
+        self._disk_bytes = None
+        self._disk_dir = None
+        self._evicting = False
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def quiet(self):
+        '''
+        Reads by this thread in the block aren't counted in `reads` or
+        `last_used`, for housekeeping such as refreshing entries.
+        '''
+        was_quiet = getattr(self._local, 'quiet', False)
+        self._local.quiet = True
+        try:
+            yield
+        finally:
+            self._local.quiet = was_quiet
+
+    @contextlib.contextmanager
+    def silent(self):
+        '''
+        `warn` prints nothing for this thread in the block, e.g. for a
+        background thread whose messages would land on the interactive view.
+        '''
+        was_silent = getattr(self._local, 'silent', False)
+        self._local.silent = True
+        try:
+            yield
+        finally:
+            self._local.silent = was_silent
+
+    def warn(self, message):
+        '''Report a failure on stderr, unless this thread is `silent`.'''
+        if not getattr(self._local, 'silent', False):
+            print(message, file=sys.stderr)
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key, with_body=True) -> Optional[Entry]:
+        '''
+        Cached entry or None. With `with_body=False` only the `.meta` file is
+        read if the entry isn't in memory, and `body` may be None.
+        '''
+        used = not getattr(self._local, 'quiet', False)
+        if used:
+            self.reads[key] += 1
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                entry = self._memory[key]
+                if used:
+                    self._mark_used(key)
+                count('cache.memory_hits')
+                return entry
+        try:
+            with span('cache.disk_read'):
+                with open(self.path(key) + META_EXT) as f:
+                    meta = json.load(f)
+                body = None
+                if with_body:
+                    with open(self.path(key), 'rb') as f:
+                        body = f.read()
+        except (OSError, ValueError):
+            count('cache.misses')
+            return None
+        count('cache.disk_hits')
+        entry = Entry(body, meta.get('etag'), meta.get('last_modified'), meta['stored_at'], meta.get('digest'))
+        with self._lock:
+            if body is not None:
+                self._remember(key, entry)
+            if used:
+                self._mark_used(key)
+        return entry
+
+    def put(self, key, body: bytes, etag=None, last_modified=None, stored_at=None,
+            in_memory=True) -> Entry:
+        entry = Entry(body, etag, last_modified, stored_at or time.time(), hashlib.sha1(body).hexdigest())
+        os.makedirs(self.directory, exist_ok=True)
+        replaced = self._file_size(key) + self._file_size(key + META_EXT)
+        # body first so a `.meta` file always has its body next to it
+        self._write_atomic(key, body)
+        self._write_meta(key, entry)
+        written = len(body) + self._file_size(key + META_EXT)
+        with self._lock:
+            if in_memory:
+                self._remember(key, entry)
+            else:
+                self._memory.pop(key, None)
+            too_big = self._track_disk(written - replaced)
+        if too_big:
+            self._evict_disk(keep=key)
+        return entry
+
+    def touch(self, key, entry: Entry) -> Entry:
+        '''Mark an entry as fresh again, e.g. after a 304 Not Modified.'''
+        entry = entry._replace(stored_at=time.time())
+        self._write_meta(key, entry)
+        with self._lock:
+            if entry.body is not None:
+                self._remember(key, entry)
+        return entry
+
+    def drop_body(self, key):
+        '''
+        Delete the body but keep the validators and digest, for payloads that
+        only matter through what was parsed out of them.
+        '''
+        with self._lock:
+            self._memory.pop(key, None)
+        size = self._file_size(key)
+        try:
+            os.unlink(self.path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._track_disk(-size)
+
+    def last_used(self, key) -> float:
+        '''When any process last read `key` (or first stored it), 0 if it's not cached.'''
+        try:
+            return os.path.getmtime(self.path(key) + META_EXT)
+        except OSError:
+            return 0
+
+    def age(self, entry: Entry) -> float:
+        return time.time() - entry.stored_at
+
+    def fetch(self, key, url, ttl, headers=None, session=None,
+              stale_while_revalidate=None, with_body=True) -> Optional[Entry]:
+        '''
+        Cached body of `url` if younger than `ttl` seconds. A stale one is
+        returned straight away and refreshed in the background, unless
+        it's more than `max_stale` seconds past its TTL or
+        `stale_while_revalidate` (by default `self.stale_while_revalidate`)
+        is off. Without a usable cached copy, fetch it now. None if there's
+        nothing to show. With `with_body=False` a cached entry may come
+        without its body.
+        '''
+        if stale_while_revalidate is None:
+            stale_while_revalidate = self.stale_while_revalidate
+        entry = self.get(key, with_body)
+        if entry and self.age(entry) < ttl:
+            count('cache.fresh')
+            return entry
+        if entry and stale_while_revalidate and self.age(entry) < ttl + self.max_stale:
+            count('cache.stale_serves')
+            self.revalidate_async(key, url, headers, session)
+            return entry
+        # a 304 is no use if we need the body and don't have it
+        return self.revalidate(key, url, headers, session, entry, conditional=entry is not None)
+
+    def revalidate(self, key, url, headers=None, session=None, entry=None,
+                   conditional=True) -> Optional[Entry]:
+        '''
+        Conditional GET of `url`: a 304 only refreshes the timestamp of the
+        cached entry. If the request fails the cached entry (maybe stale or
+        None) is returned as is. `conditional=False` always downloads the body.
+        '''
+        headers = dict(headers or {})
+        if not conditional:
+            entry = None
+        elif entry is None:
+            entry = self.get(key, with_body=False)
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        try:
+            with span('download'):
+                response = transport.get(url, headers, session)
+        # what requests raises is an OSError, and so is transport.CircuitOpenError
+        except OSError as e:
+            count('http.failures')
+            self.warn(f"Failed to fetch {url}: {e}")
+            return entry
+        count('http.requests')
+        if response.status_code == 304 and entry:
+            count('http.not_modified')
+            return self.touch(key, entry)
+        if response.status_code == 200:
+            count('http.bytes_downloaded', len(response.content))
+            return self.put(key, response.content, response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+        self.warn(f"Failed to fetch data. HTTP status code: {response.status_code}")
+        return entry
+
+    def revalidate_async(self, key, url, headers=None, session=None):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.revalidate(key, url, headers, session)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _mark_used(self, key):
+        try:
+            os.utime(self.path(key) + META_EXT)
+        except OSError:
+            pass
+
+    def _write_atomic(self, key, data: bytes):
+        # write next to the target then rename so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + key, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _write_meta(self, key, entry):
+        meta = {'etag': entry.etag, 'last_modified': entry.last_modified,
+                'stored_at': entry.stored_at, 'digest': entry.digest}
+        path = self.path(key + META_EXT)
+        try:
+            last_used = os.stat(path).st_mtime
+        except OSError:
+            last_used = None
+        self._write_atomic(key + META_EXT, json.dumps(meta).encode())
+        # a refresh isn't a use
+        if last_used is not None:
+            try:
+                os.utime(path, (last_used, last_used))
+            except OSError:
+                pass
+
+    def _file_size(self, name) -> int:
+        try:
+            return os.stat(self.path(name)).st_size
+        except OSError:
+            return 0
+
+    def _track_disk(self, delta) -> bool:
+        '''Count `delta` bytes written to the directory. True if it needs a scan. Hold `_lock`.'''
+        if self._disk_bytes is None or self._disk_dir != self.directory:
+            return not self._evicting
+        self._disk_bytes += delta
+        return self._disk_bytes > self.max_bytes and not self._evicting
+
+    def _evict_disk(self, keep=None):
+        '''
+        Delete least recently used entries until the directory fits in
+        `max_bytes`. Scans the directory without holding `_lock`, one thread
+        at a time.
+        '''
+        with self._lock:
+            if self._evicting:
+                return
+            self._evicting = True
+        directory = self.directory
+        try:
+            total = self._scan_and_evict(directory, keep)
+            with self._lock:
+                self._disk_bytes, self._disk_dir = total, directory
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def _scan_and_evict(self, directory, keep) -> int:
+        '''Returns the bytes left in `directory`.'''
+        sizes, last_used = {}, {}
+        for f in os.scandir(directory):
+            if f.name.startswith('.') or not f.is_file():
+                continue
+            key = f.name[:-len(META_EXT)] if f.name.endswith(META_EXT) else f.name
+            try:
+                stat = f.stat()
+            except OSError:
+                # deleted since it was listed, e.g. by `drop_body` in another thread
+                continue
+            sizes[key] = sizes.get(key, 0) + stat.st_size
+            if f.name.endswith(META_EXT):
+                last_used[key] = stat.st_mtime
+        total = sum(sizes.values())
+        for key in sorted(sizes, key=lambda k: last_used.get(k, 0)):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for name in (key, key + META_EXT):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except OSError:
+                    pass
+            with self._lock:
+                self._memory.pop(key, None)
+            total -= sizes[key]
+        return total
+
+
+# shared by the daily and hourly views
+cache = ForecastCache()
@@ -0,0 +1,226 @@
+'''
+One registry of the cities in city_ids.dat for every name/ID/coordinate lookup.
+
+The file is compiled once into a binary snapshot in the cache directory,
+which is memory-mapped, so opening the registry and each lookup take the
+same time however long the file is. The snapshot is rebuilt when the file's
+mtime or size changes. Layout (little endian, all sections 8-byte aligned):
+
+    header: magic 'BBCR', version u32, count u32, table size u32,
+            source mtime_ns i64, source size i64
+    ids        count x i64
+    latitudes  count x f64 (NaN if unknown)
+    longitudes count x f64 (NaN if unknown)
+    name ends  count x u32 (end offset of each name in the blob)
+    id table   size x i32 (open addressing on the id, -1 is empty)
+    name table size x i32 (open addressing on the CRC-32 of the name)
+    names      utf-8 blob
+'''
+from cache import cache
+
+import math
+import mmap
+import os
+import re
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+from typing import Iterator, List, Optional, Tuple
+
+City = namedtuple('City', ['name', 'id', 'lat', 'lon'])
+
+MAGIC = b'BBCR'
+VERSION = 1
+_HEADER = struct.Struct('<4sIIIqq')
+
+
+def parse_line(line) -> Optional[City]:
+    '''"City Name: ID: lat, lon" or "City Name: ID", None if it's neither.'''
+    parts = line.strip().split(':', 2)
+    if len(parts) < 2:
+        return None
+    try:
+        city_id = int(parts[1].strip())
+    except ValueError:
+        return None
+    lat = lon = math.nan
+    if len(parts) == 3:
+        try:
+            lat, lon = map(float, re.split(r'[,\s]+', parts[2].strip()))
+        except ValueError:
+            pass
+    return City(parts[0].strip(), city_id, lat, lon)
+
+
+def _id_hash(city_id) -> int:
+    return (city_id * 2654435761) & 0xFFFFFFFF
+
+
+def _name_hash(encoded) -> int:
+    return zlib.crc32(encoded)
+
+
+def _align(n) -> int:
+    return (n + 7) & ~7
+
+
+def compile_registry(file_path, mtime_ns, size) -> bytes:
+    cities = []
+    with open(file_path, encoding='utf-8') as f:
+        for line in f:
+            city = parse_line(line)
+            if city:
+                cities.append(city)
+    count = len(cities)
+    table_size = 1
+    while table_size < 2 * count:
+        table_size *= 2
+    ids, lats, lons, ends = array('q'), array('d'), array('d'), array('I')
+    id_table, name_table = array('i', [-1]) * table_size, array('i', [-1]) * table_size
+    blob = bytearray()
+    for i, city in enumerate(cities):
+        encoded = city.name.encode('utf-8')
+        blob += encoded
+        ids.append(city.id)
+        lats.append(city.lat)
+        lons.append(city.lon)
+        ends.append(len(blob))
+        # id -> first line with it
+        slot = _id_hash(city.id) & (table_size - 1)
+        while id_table[slot] != -1 and ids[id_table[slot]] != city.id:
+            slot = (slot + 1) & (table_size - 1)
+        if id_table[slot] == -1:
+            id_table[slot] = i
+        # name -> last line with it, like building a dict would
+        slot = _name_hash(encoded) & (table_size - 1)
+        while name_table[slot] != -1 and cities[name_table[slot]].name != city.name:
+            slot = (slot + 1) & (table_size - 1)
+        name_table[slot] = i
+    sections = [ids, lats, lons, ends, id_table, name_table, blob]
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, count, table_size, mtime_ns, size))
+    for section in sections:
+        out += bytes(section)
+        out += b'\0' * (_align(len(out)) - len(out))
+    return bytes(out)
+
+
+class CityRegistry:
+    '''
+    Name -> id, id -> name and id -> coordinates lookups backed by a
+    memory-mapped snapshot of city_ids.dat. Use `CityRegistry.load()`.
+    '''
+    def __init__(self, snapshot_path, source_stat=None):
+        with open(snapshot_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, table_size, mtime_ns, size = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{snapshot_path} is not a city registry snapshot we know")
+        if source_stat and (mtime_ns, size) != (source_stat.st_mtime_ns, source_stat.st_size):
+            raise ValueError(f"{snapshot_path} is outdated")
+        self.source = (mtime_ns, size)
+        self.snapshot_path = snapshot_path
+        self._count, self._table_size = count, table_size
+        view, offset = memoryview(self._mm), _HEADER.size
+
+        def section(fmt, n):
+            nonlocal offset
+            itemsize = struct.calcsize(fmt)
+            start, offset = offset, _align(offset + n * itemsize)
+            return view[start:start + n * itemsize].cast(fmt)
+
+        self._ids = section('q', count)
+        self._lats = section('d', count)
+        self._lons = section('d', count)
+        self._ends = section('I', count)
+        self._id_table = section('i', table_size)
+        self._name_table = section('i', table_size)
+        self._blob_start = offset
+
+    @classmethod
+    def load(cls, file_path='city_ids.dat') -> 'CityRegistry':
+        '''Registry of `file_path`, compiling it first if it's new or has changed.'''
+        stat = os.stat(file_path)
+        path = os.path.abspath(file_path)
+        registry = _registries.get(path)
+        if registry and registry.source == (stat.st_mtime_ns, stat.st_size):
+            return registry
+        key = f"cities_{zlib.crc32(path.encode()):08x}.idx"
+        try:
+            # also marks it as used for the cache's eviction
+            if cache.get(key, with_body=False) is None:
+                raise OSError
+            registry = cls(cache.path(key), stat)
+        except (OSError, ValueError, struct.error):
+            # it's memory-mapped, no need to keep a copy in memory too
+            cache.put(key, compile_registry(file_path, stat.st_mtime_ns, stat.st_size), in_memory=False)
+            registry = cls(cache.path(key), stat)
+        _registries[path] = registry
+        return registry
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _name(self, i) -> str:
+        start = self._ends[i - 1] if i else 0
+        return self._mm[self._blob_start + start:self._blob_start + self._ends[i]].decode('utf-8')
+
+    def name_at(self, i) -> str:
+        '''Name on the `i`th line of the file (counting only lines with a city).'''
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._name(i)
+
+    def _coords(self, i) -> Optional[Tuple[float, float]]:
+        lat, lon = self._lats[i], self._lons[i]
+        if math.isnan(lat) or math.isnan(lon):
+            return None
+        return lat, lon
+
+    def _index_of_id(self, city_id) -> int:
+        try:
+            city_id = int(city_id)
+        except ValueError:
+            return -1
+        if not self._count:
+            return -1
+        slot = _id_hash(city_id) & (self._table_size - 1)
+        while self._id_table[slot] != -1:
+            i = self._id_table[slot]
+            if self._ids[i] == city_id:
+                return i
+            slot = (slot + 1) & (self._table_size - 1)
+        return -1
+
+    def id_of(self, name) -> Optional[int]:
+        '''Id of the city with exactly this name.'''
+        if not self._count:
+            return None
+        slot = _name_hash(name.encode('utf-8')) & (self._table_size - 1)
+        while self._name_table[slot] != -1:
+            i = self._name_table[slot]
+            if self._name(i) == name:
+                return self._ids[i]
+            slot = (slot + 1) & (self._table_size - 1)
+        return None
+
+    def name_of(self, city_id) -> Optional[str]:
+        i = self._index_of_id(city_id)
+        return self._name(i) if i >= 0 else None
+
+    def coords_of(self, city_id) -> Optional[Tuple[float, float]]:
+        i = self._index_of_id(city_id)
+        return self._coords(i) if i >= 0 else None
+
+    def names(self) -> List[str]:
+        '''All names in file order (duplicates included).'''
+        return [self._name(i) for i in range(self._count)]
+
+    def __iter__(self) -> Iterator[City]:
+        for i in range(self._count):
+            coords = self._coords(i) or (None, None)
+            yield City(self._name(i), self._ids[i], *coords)
+
+
+# loaded registries by absolute path of their file
+_registries = {}
@@ -1,11 +1,27 @@
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
-import requests
-from typing import Tuple, List
+from cache import cache
+from cities import CityRegistry
+from profiling import span
+import transport
+
+import heapq
+import json
+import math
+import os
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+INDEX_VERSION = 1
+LOCATION_URL = 'https://ipinfo.io/json'
+# geocoded coordinates of cities listed without any, by name
+GEOCODED_KEY = 'geocoded_cities.json'
+# nearest candidates by straight-line distance that get re-ranked by geodesic
+# distance, the two orders only differ by the earth's flattening
+RERANK_FACTOR = 4
 
 def get_current_location() -> Tuple[int, int]:
     try:
-        response = requests.get('https://ipinfo.io/json', timeout=5)
+        with span('location'):
+            response = transport.get(LOCATION_URL, timeout=(transport.CONNECT_TIMEOUT_SEC, 5))
         data = response.json()
         loc = data['loc']
         latitude, longitude = map(float, loc.split(','))
@@ -13,31 +29,152 @@ def get_current_location() -> Tuple[int, int]:
     except Exception as e:
         return None
 
+def read_city_coordinates(city_ids_file='city_ids.dat') -> Dict[str, Optional[Tuple[float, float]]]:
+    '''Coordinates of each city in the file, None for the ones listed without any.'''
+    return {city.name: None if city.lat is None else (city.lat, city.lon)
+            for city in CityRegistry.load(city_ids_file)}
+
+def geocode(city_name) -> Optional[Tuple[float, float]]:
+    '''Look a city up online. Results are cached so each city is only looked up once.'''
+    entry = cache.get(GEOCODED_KEY)
+    geocoded = json.loads(entry.body) if entry else {}
+    if city_name in geocoded:
+        return tuple(geocoded[city_name])
+    # geopy is slow to import and only needed here and in `CityIndex.nearest`
+    from geopy.geocoders import Nominatim
+    geolocator = Nominatim(user_agent="city_locator")
+    with span('geocode'):
+        location = geolocator.geocode(city_name)
+    if not location:
+        return None
+    geocoded[city_name] = (location.latitude, location.longitude)
+    cache.put(GEOCODED_KEY, json.dumps(geocoded).encode())
+    return geocoded[city_name]
+
 def get_city_coordinates(city_name, city_ids_file='city_ids.dat'):
     # try fetching coordinates from file (offline)
-    with open(city_ids_file) as f:
-        for line in f.readlines():
-            try:
-                if city_name.lower() == line.split(':')[0].lower():
-                    return float(line.split(':')[2].split(',')[0]),\
-                           float(line.split(':')[2].split(',')[1])
-            except:
-                break
+    registry = CityRegistry.load(city_ids_file)
+    city_id = registry.id_of(city_name)
+    if city_id is None:
+        city_id = next((c.id for c in registry if c.name.lower() == city_name.lower()), None)
+    coords = registry.coords_of(city_id) if city_id is not None else None
+    if coords:
+        return coords
     # else look them up
-    geolocator = Nominatim(user_agent="city_locator")
-    location = geolocator.geocode(city_name)
-    if location:
-        return (location.latitude, location.longitude)
-    else:
-        return None
-            
+    return geocode(city_name)
+
+def to_unit_vector(lat, lon) -> Tuple[float, float, float]:
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+class CityIndex:
+    '''
+    KD-tree of the cities on the unit sphere (3D vectors, so there's no
+    trouble around the poles or the antimeridian). It's stored implicitly:
+    the node of the points in [lo, hi) is the middle one and splits them on
+    axis depth % 3, so the whole tree is a list that's cheap to persist.
+    '''
+    def __init__(self, names: List[str], coords: List[Tuple[float, float]]):
+        self.names = names
+        self.coords = coords
+        self._points = [to_unit_vector(*c) for c in coords]
+        self._order = list(range(len(names)))
+        self._build(0, len(self._order), 0)
+
+    @classmethod
+    def from_tree(cls, names, coords):
+        '''Index over names and coordinates already in tree order, see `to_json`.'''
+        index = cls.__new__(cls)
+        index.names, index.coords = names, coords
+        index._points = [to_unit_vector(*c) for c in coords]
+        index._order = list(range(len(names)))
+        return index
+
+    def _build(self, lo, hi, depth):
+        if hi - lo <= 1:
+            return
+        axis, mid = depth % 3, (lo + hi) // 2
+        self._order[lo:hi] = sorted(self._order[lo:hi], key=lambda i: self._points[i][axis])
+        self._build(lo, mid, depth + 1)
+        self._build(mid + 1, hi, depth + 1)
+
+    def to_json(self) -> Dict:
+        return {'names': [self.names[i] for i in self._order],
+                'coords': [self.coords[i] for i in self._order]}
+
+    def nearest(self, lat, lon, k=1, allowed: Optional[set] = None) -> List[Tuple[str, float]]:
+        '''
+        The `k` closest cities to (lat, lon) as (name, km) by geodesic
+        distance, closest first. If `allowed` is given only those names count.
+        '''
+        from geopy.distance import geodesic
+        query = to_unit_vector(lat, lon)
+        ncandidates = max(k * RERANK_FACTOR, 8)
+        # max-heap of (-squared chord distance, point)
+        best = []
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            axis, mid = depth % 3, (lo + hi) // 2
+            i = self._order[mid]
+            p = self._points[i]
+            if allowed is None or self.names[i] in allowed:
+                d2 = sum((a - b) ** 2 for a, b in zip(p, query))
+                if len(best) < ncandidates:
+                    heapq.heappush(best, (-d2, i))
+                elif -best[0][0] > d2:
+                    heapq.heapreplace(best, (-d2, i))
+            diff = query[axis] - p[axis]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            search(*near, depth + 1)
+            # the other side can only help if the splitting plane is closer than the worst kept
+            if len(best) < ncandidates or diff * diff < -best[0][0]:
+                search(*far, depth + 1)
+
+        search(0, len(self._order), 0)
+        ranked = sorted((geodesic((lat, lon), self.coords[i]).kilometers, self.names[i]) for _, i in best)
+        return [(name, km) for km, name in ranked[:k]]
+
+
+def _index_key(city_ids_file) -> str:
+    return f"city_index_{zlib.crc32(os.path.abspath(city_ids_file).encode()):08x}.json"
+
+def load_index(city_ids_file='city_ids.dat') -> CityIndex:
+    '''
+    Index of every city in the file. It's built once and persisted in the
+    cache, and rebuilt whenever the file changes.
+    '''
+    source = [INDEX_VERSION, *CityRegistry.load(city_ids_file).source]
+    key = _index_key(city_ids_file)
+    entry = cache.get(key)
+    if entry:
+        try:
+            stored = json.loads(entry.body)
+            if stored['source'] == source:
+                return CityIndex.from_tree(stored['names'], [tuple(c) for c in stored['coords']])
+        except (ValueError, KeyError):
+            pass
+    names, coords = [], []
+    for name, city_coords in read_city_coordinates(city_ids_file).items():
+        city_coords = city_coords or geocode(name)
+        if city_coords:
+            names.append(name)
+            coords.append(city_coords)
+    index = CityIndex(names, coords)
+    cache.put(key, json.dumps(dict(source=source, **index.to_json())).encode())
+    return index
 
-def find_closest_city(cities: List[str]) -> Tuple[str, float]:
+def find_closest_city(cities: Iterable[str] = None) -> Tuple[str, float]:
     current_location = get_current_location()
-    print("Finding your closest city... this will take a several seconds")
-    closest_city, min_distance = sorted(
-        ((city, geodesic(current_location, get_city_coordinates(city)).kilometers) for city in cities),
-        key=lambda x: x[1]
-    )[0]
+    if current_location is None:
+        raise RuntimeError("Could not detect your location, please enter a city name.")
+    print("Finding your closest city...")
+    with span('city_index'):
+        index = load_index()
+    with span('nearest_city'):
+        closest_city, min_distance = index.nearest(
+            *current_location, k=1, allowed=set(cities) if cities is not None else None)[0]
     print(f"Found {closest_city}")
     return closest_city, min_distance
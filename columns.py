@@ -0,0 +1,156 @@
+'''
+Column storage of a city's hourly reports: one array per field instead of a
+namedtuple per hour, a table of the distinct weather texts, and the range of
+rows of each date. A 14-day forecast is a few kilobytes, and per-day
+statistics run over array slices in C instead of over Python objects.
+'''
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+from itertools import repeat
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+WeatherReport = namedtuple(
+    "WeatherReport",
+    [
+        "localDate",
+        "timeslot",
+        "weatherTypeText",
+        "temperatureC",
+        "precipitationProbabilityInPercent",
+        "humidity",
+        "windSpeedKph",
+    ]
+)
+
+# stored instead of missing values
+MISSING = -32768
+# the numeric columns, in `WeatherReport` order
+VALUE_COLUMNS = ('temperature', 'precipitation', 'humidity', 'wind')
+
+
+def _value(x) -> int:
+    # BBC only sends whole numbers, anything else is rounded
+    return MISSING if x is None else int(round(x))
+
+
+def _unvalue(x):
+    return None if x == MISSING else x
+
+
+# "HH:MM" of every minute of the day
+TIMESLOTS = [f"{m // 60:02d}:{m % 60:02d}" for m in range(24 * 60)]
+
+
+def _minutes(timeslot) -> int:
+    hours, minutes = timeslot.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class HourlyColumns(Mapping):
+    '''
+    Hourly reports of a city by date. Reads like the old `{date: [WeatherReport]}`
+    defaultdict: the reports of a date are built only when they're asked for,
+    and a date without any reads as []. The columns are `minutes` (of the
+    day), `types` (index into `texts`), `temperature`, `precipitation`,
+    `humidity` and `wind`, with rows grouped by date in `bounds`.
+    '''
+    def __init__(self, dates: List[Tuple[str, int]] = (), texts: List[str] = (), minutes=None, types=None,
+                 temperature=None, precipitation=None, humidity=None, wind=None):
+        '''`dates` are (date, number of reports) in row order.'''
+        self.texts = list(texts)
+        self.minutes = minutes if minutes is not None else array('H')
+        self.types = types if types is not None else array('H')
+        self.temperature = temperature if temperature is not None else array('h')
+        self.precipitation = precipitation if precipitation is not None else array('h')
+        self.humidity = humidity if humidity is not None else array('h')
+        self.wind = wind if wind is not None else array('h')
+        self.bounds: Dict[str, Tuple[int, int]] = {}
+        start = 0
+        for date, count in dates:
+            self.bounds[date] = (start, start + count)
+            start += count
+
+    @classmethod
+    def from_reports(cls, reports: Iterable[Tuple]) -> 'HourlyColumns':
+        '''Columns of rows shaped like `WeatherReport`, grouped by date in order of appearance.'''
+        by_date = {}
+        for report in reports:
+            by_date.setdefault(report[0], []).append(report)
+        columns, index = cls(), {}
+        for date, rows in by_date.items():
+            for _, timeslot, text, *values in rows:
+                if text not in index:
+                    index[text] = len(columns.texts)
+                    columns.texts.append(text)
+                columns.minutes.append(_minutes(timeslot))
+                columns.types.append(index[text])
+                for name, value in zip(VALUE_COLUMNS, values):
+                    getattr(columns, name).append(_value(value))
+            start = len(columns.minutes) - len(rows)
+            columns.bounds[date] = (start, start + len(rows))
+        return columns
+
+    def slice_of(self, date) -> slice:
+        '''Rows of a date, an empty slice if there are none.'''
+        start, stop = self.bounds.get(date, (0, 0))
+        return slice(start, stop)
+
+    def report(self, date, i) -> WeatherReport:
+        return WeatherReport(date, TIMESLOTS[self.minutes[i]], self.texts[self.types[i]],
+                             *(_unvalue(getattr(self, name)[i]) for name in VALUE_COLUMNS))
+
+    def __getitem__(self, date) -> List[WeatherReport]:
+        if date not in self.bounds:
+            return []
+        start, stop = self.bounds[date]
+        rows = slice(start, stop)
+        values = [getattr(self, name)[rows] for name in VALUE_COLUMNS]
+        if any(MISSING in column for column in values):
+            values = [[_unvalue(v) for v in column] for column in values]
+        # zipped and mapped in C, a loop in Python would take twice as long
+        return list(map(WeatherReport._make, zip(repeat(date), map(TIMESLOTS.__getitem__, self.minutes[rows]),
+                                                 map(self.texts.__getitem__, self.types[rows]), *values)))
+
+    def get(self, date, default=None):
+        # like a defaultdict's, `default` for a date without reports
+        return self[date] if date in self.bounds else default
+
+    def __contains__(self, date) -> bool:
+        return date in self.bounds
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.bounds)
+
+    def __len__(self) -> int:
+        return len(self.bounds)
+
+    def _day_values(self, column, date):
+        values = getattr(self, column)[self.slice_of(date)]
+        if MISSING in values:
+            values = array(values.typecode, (v for v in values if v != MISSING))
+        return values
+
+    def day_min(self, date, column='temperature') -> Optional[int]:
+        values = self._day_values(column, date)
+        return min(values) if values else None
+
+    def day_max(self, date, column='temperature') -> Optional[int]:
+        values = self._day_values(column, date)
+        return max(values) if values else None
+
+    def day_mean(self, date, column='temperature') -> Optional[float]:
+        values = self._day_values(column, date)
+        return sum(values) / len(values) if values else None
+
+    def daily_stats(self, column='temperature') -> Dict[str, Tuple[int, int, float]]:
+        '''(min, max, mean) of a column for every date with any values.'''
+        stats = {}
+        for date in self.bounds:
+            values = self._day_values(column, date)
+            if values:
+                stats[date] = (min(values), max(values), sum(values) / len(values))
+        return stats
+
+    def __repr__(self) -> str:
+        return f"HourlyColumns({len(self.minutes)} reports over {len(self.bounds)} dates)"
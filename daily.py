@@ -0,0 +1,296 @@
+from hourly import request_aggregated, summary_from_aggregated
+from archive import archive
+from cache import cache
+import parsed_cache
+from profiling import count, span
+from weather_icons import get_weather_emoji
+
+from html.parser import HTMLParser
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Dict, List
+import re
+import sys
+
+PAGE_URL = "https://www.bbc.com/weather/{}"
+PAGE_TTL_SEC = 2 * 3600
+
+# Encapsulate the data in each day
+Weather = namedtuple('Weather', ['descr', 'date', 'temp_low', 'temp_high'])
+# What we keep from each <a id="daylink-N"> subtree: the text of the first
+# weather description div and the texts of all the Celsius temperature spans
+DayRecord = namedtuple('DayRecord', ['descr', 'temps'])
+
+DESCR_CLASS = 'wr-day__details__weather-type-description'
+TEMP_CLASS = 'wr-value--temperature--c'
+# tags that never get a closing tag so they must not go in the open tag stack
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+    'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+}
+
+
+def has_class(attrs, cls) -> bool:
+    for name, value in attrs:
+        if name == 'class' and value and (value == cls or cls in value.split()):
+            return True
+    return False
+
+
+class DaylinkParser(HTMLParser):
+    '''
+    Single pass, incremental extractor for BBC's daily forecast page.
+    It only looks inside the `daylink-*` anchors and stops as soon as the
+    last one (`daylink-{ndays-1}`) has been closed.
+    '''
+    def __init__(self, ndays=14):
+        super().__init__(convert_charrefs=True)
+        self.last_id = f"daylink-{ndays - 1}"
+        self.days = {}
+        self.done = False
+        # open tags of the anchor we're in: [tag, text buffer or None]
+        self._stack = []
+        self._day_id = None
+        self._descr = None
+        self._temps = None
+        self._buffers = []
+
+    def _update_buffers(self):
+        self._buffers = [buf for _, buf in self._stack if buf is not None]
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if not self._stack:
+            if tag != 'a':
+                return
+            day_id = dict(attrs).get('id')
+            # like soup.find(), only the first anchor with a given id counts
+            if not day_id or not day_id.startswith('daylink-') or day_id in self.days:
+                return
+            self._day_id, self._descr, self._temps = day_id, None, []
+            self._stack.append([tag, None])
+            return
+        if tag in VOID_TAGS:
+            return
+        buf = None
+        if tag == 'div' and self._descr is None and has_class(attrs, DESCR_CLASS):
+            buf = self._descr = []
+        elif tag == 'span' and has_class(attrs, TEMP_CLASS):
+            buf = []
+            self._temps.append(buf)
+        self._stack.append([tag, buf])
+        if buf is not None:
+            self._update_buffers()
+
+    def handle_endtag(self, tag):
+        if self.done or not self._stack:
+            return
+        # close everything up to the matching open tag, ignore stray end tags
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                del self._stack[i:]
+                self._update_buffers()
+                break
+        if not self._stack:
+            self._finish_day()
+
+    def handle_data(self, data):
+        for buf in self._buffers:
+            buf.append(data)
+
+    def _finish_day(self):
+        descr = ''.join(self._descr) if self._descr is not None else None
+        self.days[self._day_id] = DayRecord(descr, [''.join(t) for t in self._temps])
+        if self._day_id == self.last_id:
+            self.done = True
+
+    def close(self):
+        super().close()
+        # an anchor left open at EOF is closed implicitly
+        if self._stack and not self.done:
+            self._stack = []
+            self._update_buffers()
+            self._finish_day()
+
+
+def extract_days(source, ndays=14, chunk_size=1 << 16) -> Dict[str, DayRecord]:
+    '''
+    Extract the `daylink-*` records from an HTML string or a text file object.
+    File objects are read in chunks and reading stops after the last day.
+    '''
+    parser = DaylinkParser(ndays)
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(chunk_size), '')
+    else:
+        chunks = (source[i:i + chunk_size] for i in range(0, len(source), chunk_size))
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    else:
+        parser.close()
+    return parser.days
+
+
+def extract_days_soup(html_content, ndays=14) -> Dict[str, DayRecord]:
+    '''
+    Reference implementation of `extract_days` that parses the full DOM with
+    BeautifulSoup. Slow, only kept to compare against.
+    '''
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    days = {}
+    for day in range(ndays):
+        a_tag = soup.find('a', id=f"daylink-{day}")
+        if not a_tag:
+            continue
+        descr = a_tag.find('div', class_=DESCR_CLASS)
+        temps = a_tag.find_all('span', class_=TEMP_CLASS)
+        days[f"daylink-{day}"] = DayRecord(descr.text if descr else None, [t.text for t in temps])
+    return days
+
+
+def daily_from_summaries(summaries, use_emojis=True) -> List[Weather]:
+    '''
+    Build the daily cards from the per-day `summary` blocks of BBC's aggregated
+    forecast payload (the same one the hourly view uses).
+    '''
+    daily_data = []
+    for summary in summaries:
+        descr = summary.description
+        # late in the evening today's high is gone
+        temp_low = 'N/A' if summary.minTempC is None else summary.minTempC
+        temp_high = 'N/A' if summary.maxTempC is None else summary.maxTempC
+        if 'N/A' not in (temp_low, temp_high) and temp_high < temp_low:
+            temp_low, temp_high = temp_high, temp_low
+        if use_emojis:
+            descr = f"{get_weather_emoji(descr)} {descr}"
+        date = datetime.strptime(summary.localDate, '%Y-%m-%d')
+        daily_data.append(Weather(descr, f"{date.strftime('%a, %d %b %Y')}", temp_low, temp_high))
+    return daily_data
+
+
+def daily_from_aggregated(data, use_emojis=True) -> List[Weather]:
+    return daily_from_summaries(summary_from_aggregated(data), use_emojis)
+
+
+def id2page(city_id) -> str:
+    return PAGE_URL.format(city_id)
+
+
+def request_daily(city_id, use_emojis=True, session=None) -> List[Weather]:
+    '''
+    Daily cards from BBC's (cached) aggregated API. Empty if the request failed.
+    '''
+    aggregated = request_aggregated(city_id, session)
+    if not aggregated:
+        return []
+    return daily_from_summaries(aggregated[0], use_emojis)
+
+
+def scrape(url, use_emojis=True, verbose=False, session=None) -> List:
+    ### Make a GET request and capture response, or use the cache
+    location_id = url.split("/")[-1]  # Extract last part of the URL
+    html_file = f"{location_id}.html"
+    entry = cache.fetch(html_file, url, PAGE_TTL_SEC, session=session, with_body=False)
+    if entry is None:
+        if verbose:
+            print(f"No cached or downloaded page for {url}", file=sys.stderr)
+        return []
+    # if this page was parsed already don't even read it
+    parsed = parsed_cache.load(html_file, entry.digest)
+    if parsed:
+        count('parsed.snapshot_hits')
+        if verbose:
+            print(f"Using parsed page cached {cache.age(entry):.0f} s ago", file=sys.stderr)
+        daily_data = weather_from_snapshot(parsed[0])
+    else:
+        if entry.body is None:
+            entry = cache.get(html_file) or cache.revalidate(html_file, url, session=session, conditional=False)
+            if entry is None:
+                return []
+        with span('parse_page'):
+            daily_data = parse_page(entry.body.decode("utf-8", errors="replace"), verbose)
+        parsed_cache.store(html_file, entry.digest, daily_data)
+        archive_page(location_id, entry, daily_data)
+    if use_emojis:
+        daily_data = [w._replace(descr=f"{get_weather_emoji(w.descr)} {w.descr}") for w in daily_data]
+    return daily_data
+
+
+def weather_from_snapshot(days) -> List[Weather]:
+    '''Daily cards (without emojis) from the days of a parsed page snapshot.'''
+    return [Weather(descr, date, 'N/A' if low is None else low, 'N/A' if high is None else high)
+            for descr, date, low, high in days]
+
+
+def archive_page(location_id, entry, daily_data):
+    '''Record the days parsed out of the page cached as `entry` in the archive.'''
+    archive.record(location_id, entry.stored_at, entry.digest, source='page', days=[
+        (datetime.strptime(w.date, '%a, %d %b %Y').strftime('%Y-%m-%d'), w.descr,
+         None if w.temp_low == 'N/A' else w.temp_low, None if w.temp_high == 'N/A' else w.temp_high)
+        for w in daily_data])
+
+
+def parse_page(html_content, verbose=False) -> List[Weather]:
+    '''Daily cards (descriptions without emojis) from BBC's daily forecast page.'''
+    ### Extract the relevant tags for the next 2 weeks
+    ndays = 14 # that's how much BBC typically forecasts for
+    days = extract_days(html_content, ndays)
+    daily_data = []
+    # TODO: at night it should be (1, ndays) or we have a missing high temp
+    for day in range(0, ndays):
+        day_id = f"daylink-{day}"
+        extract_numbers = lambda x: [int(xx) for xx in re.findall(r'\d+', x)]
+        try:
+            date = datetime.now() + timedelta(days=day)
+            descr, temp_low, temp_high = 'N/A', 'N/A', 'N/A'
+            # Everything is under the <a> with `day_id`
+            a_tag = days.get(day_id)
+            if not a_tag:
+                continue
+            # There will be one short weather description
+            if a_tag.descr is not None:
+                descr = a_tag.descr.strip()
+            # Extract the temperatures - there will always be two spans (low and high)
+            temperature_spans = a_tag.temps
+            if temperature_spans:
+                temp_high = extract_numbers(temperature_spans[0].strip())[0]
+                temp_low = extract_numbers(temperature_spans[1].strip())[0]
+                if temp_high < temp_low:
+                    temp_low, temp_high = temp_high, temp_low
+        except Exception as e:
+            if verbose:
+                print(f"Error processing '{day_id}': {e}", file=sys.stderr)
+            descr, temp_low, temp_high = 'N/A', 'N/A', 'N/A'
+            descr = a_tag.descr.strip()
+            # When it's late in the evening the <a> with id=dailink-0 is skipped
+            temps = a_tag.temps
+            if not temps:
+                continue
+            elif len(temps) == 1:
+                temp_low = extract_numbers(temps[0].strip())[0]
+            elif len(temps) == 2:
+                temp_low = extract_numbers(temps[0].strip())[0]
+                temp_high = extract_numbers(temps[1].strip())[1]
+        daily_data.append(Weather(descr, f"{date.strftime('%a, %d %b %Y')}", temp_low, temp_high))
+    return daily_data
+
+
+def get_daily(city_id, use_emojis=True, verbose=False, session=None) -> List:
+    '''
+    Daily forecast from the aggregated API, which the hourly view uses too.
+    Falls back to scraping the HTML page if the API is unavailable.
+    '''
+    try:
+        daily_data = request_daily(city_id, use_emojis, session)
+    # what requests raises is an OSError, and it's not imported unless we download
+    except OSError as e:
+        if verbose:
+            print(f"Aggregated API failed: {e}", file=sys.stderr)
+        daily_data = []
+    if daily_data:
+        return daily_data
+    return scrape(id2page(city_id), use_emojis, verbose, session)
@@ -0,0 +1,119 @@
+'''
+Stream the daily and hourly forecasts of many cities as NDJSON or CSV, for
+other programs. It's a pipeline of generators: cities are fetched a few at a
+time (see `batch.fetch_many`), turned into rows and written out as each one
+arrives, so memory stays flat however many cities there are.
+'''
+from batch import DEFAULT_CONCURRENCY, fetch_many, iter_city_list
+
+import csv
+import gzip
+import io
+import json
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List
+
+FORMATS = ('ndjson', 'csv')
+# every row has all of these, the ones that don't apply to its kind are empty
+FIELDS = ['city_id', 'kind', 'date', 'timeslot', 'description', 'temp_low', 'temp_high',
+          'temperature', 'precipitation', 'humidity', 'wind_speed']
+
+
+def _number(value):
+    return None if value == 'N/A' else value
+
+
+def daily_rows(city) -> Iterator[Dict]:
+    '''
+    Rows of the days of a `batch.CityForecast` fetched without emojis:
+    ISO dates and None for missing temperatures.
+    '''
+    for weather in city.daily:
+        yield {'city_id': city.city_id, 'kind': 'daily',
+               'date': datetime.strptime(weather.date, '%a, %d %b %Y').strftime('%Y-%m-%d'),
+               'description': weather.descr,
+               'temp_low': _number(weather.temp_low), 'temp_high': _number(weather.temp_high)}
+
+
+def hourly_rows(city, dates=None) -> Iterator[Dict]:
+    '''Rows of the hourly reports of a `batch.CityForecast`, of all its dates or just `dates`.'''
+    for date in city.hourly if dates is None else dates:
+        for report in city.hourly[date]:
+            yield {'city_id': city.city_id, 'kind': 'hourly', 'date': date, 'timeslot': report.timeslot,
+                   'description': report.weatherTypeText, 'temperature': report.temperatureC,
+                   'precipitation': report.precipitationProbabilityInPercent,
+                   'humidity': report.humidity, 'wind_speed': report.windSpeedKph}
+
+
+def city_rows(city) -> Iterator[Dict]:
+    '''Rows of one `batch.CityForecast`: its days, then its hours.'''
+    yield from daily_rows(city)
+    yield from hourly_rows(city)
+
+
+def rows_by_city(city_ids: Iterable[int], concurrency=DEFAULT_CONCURRENCY,
+                 hourly=True, workers=0) -> Iterator[List[Dict]]:
+    '''The rows of each city as soon as it's fetched. Failed cities are reported and skipped.'''
+    for city in fetch_many(city_ids, concurrency, use_emojis=False, workers=workers):
+        if city.error:
+            print(f"{city.city_id}: ERROR {city.error}", file=sys.stderr)
+            continue
+        if not hourly:
+            city = city._replace(hourly={})
+        yield list(city_rows(city))
+
+
+def write_ndjson(rows: Iterable[Dict], out):
+    for row in rows:
+        out.write(json.dumps(row, ensure_ascii=False))
+        out.write('\n')
+
+
+def write_csv(rows: Iterable[Dict], out, header=True):
+    writer = csv.DictWriter(out, FIELDS, lineterminator='\n')
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+
+
+def open_output(path='-', compress=False):
+    '''Text stream to write to, `-` is stdout. Gzipped if `compress` or the path ends in .gz.'''
+    compress = compress or path.endswith('.gz')
+    if path == '-':
+        if not compress:
+            return sys.stdout
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb'), encoding='utf-8')
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def export(city_ids: Iterable[int], out, fmt='ndjson', concurrency=DEFAULT_CONCURRENCY, hourly=True,
+           workers=0) -> int:
+    '''Write the forecasts of the cities to the text stream `out`, city by city. Returns the rows written.'''
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, use one of {', '.join(FORMATS)}")
+    nrows = 0
+    for icity, rows in enumerate(rows_by_city(city_ids, concurrency, hourly, workers)):
+        if fmt == 'csv':
+            write_csv(rows, out, header=icity == 0)
+        else:
+            write_ndjson(rows, out)
+        # so whoever reads the stream gets each city as it comes
+        out.flush()
+        nrows += len(rows)
+    return nrows
+
+
+def export_file(city_list_file, output='-', fmt='ndjson', compress=False,
+                concurrency=DEFAULT_CONCURRENCY, hourly=True, workers=0) -> int:
+    '''Export the cities listed in a file (see `batch.iter_city_list`).'''
+    out = open_output(output, compress)
+    try:
+        return export(iter_city_list(city_list_file), out, fmt, concurrency, hourly, workers)
+    finally:
+        if out is sys.stdout:
+            out.flush()
+        else:
+            out.close()
@@ -0,0 +1,221 @@
+'''
+Fuzzy matching of city names. The trigram index of a large city registry is
+kept in the cache directory next to the registry's snapshot and
+memory-mapped, so it's built once per version of city_ids.dat rather than
+in every process. Layout (little endian):
+
+    header: magic 'BBCT', version u32, source mtime_ns i64, source size i64,
+            names u32, trigrams u32
+    names     names x u32 (registry line of each distinct name, first one)
+    trigrams  per trigram: utf-8 length u8, utf-8 bytes, typecode u8,
+              postings u32
+    postings  the postings of every trigram, in the same order, each 4-byte
+              aligned: indices into the names as u32 ('I'), or as u16
+              differences from the previous one ('H') when they all fit,
+              which halves the size of the common trigrams
+'''
+from cache import cache
+
+from array import array
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+import heapq
+from itertools import accumulate
+import mmap
+from operator import sub
+import os
+import struct
+import sys
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+# names scored with difflib at most, the rest is pruned by shared trigrams
+MAX_CANDIDATES = 200
+# trigrams found in more than this fraction of the names barely tell them apart
+COMMON_TRIGRAM_FRACTION = 0.1
+
+
+def trigrams(s) -> Set[str]:
+    s = f"  {s.lower()} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class TrigramIndex:
+    '''
+    Fuzzy name search: an inverted index from trigrams to names picks the
+    candidates that share the most trigrams with the query, and only those
+    are scored with difflib's ratio, exactly like `difflib.get_close_matches`.
+    With up to `max_candidates` names every name is scored, so the results
+    are the same as get_close_matches' and there's nothing to index.
+    '''
+    def __init__(self, names: Iterable[str], max_candidates=MAX_CANDIDATES, postings=None):
+        self.max_candidates = max_candidates
+        if postings is not None:
+            # a loaded index: the names are distinct already, and may be read lazily
+            self.names, self._postings = names, postings
+            return
+        # unique names, in order of first appearance
+        self.names = list(dict.fromkeys(names))
+        self._postings = build_postings(self.names) if len(self.names) > max_candidates else {}
+
+    def candidates(self, query) -> Iterable[int]:
+        if len(self.names) <= self.max_candidates:
+            return range(len(self.names))
+        postings = [self._postings[g] for g in trigrams(query) if g in self._postings]
+        rare = [p for p in postings if len(p) <= COMMON_TRIGRAM_FRACTION * len(self.names)]
+        counts = Counter()
+        for posting in rare or postings:
+            counts.update(posting)
+        return [i for i, _ in counts.most_common(self.max_candidates)]
+
+    def search(self, query, k=1, cutoff=0.3) -> List[Tuple[str, float]]:
+        '''The `k` best (name, ratio) matches with a ratio of at least `cutoff`, best first.'''
+        s = SequenceMatcher()
+        s.set_seq2(query)
+        scored = []
+        for i in self.candidates(query):
+            name = self.names[i]
+            s.set_seq1(name)
+            if s.real_quick_ratio() >= cutoff and s.quick_ratio() >= cutoff:
+                ratio = s.ratio()
+                if ratio >= cutoff:
+                    scored.append((ratio, name))
+        # same tie breaking as get_close_matches
+        return [(name, score) for score, name in heapq.nlargest(k, scored)]
+
+
+def build_postings(names: Sequence[str]) -> Dict[str, array]:
+    '''Trigram -> indices of the names with it.'''
+    postings = defaultdict(list)
+    for i, name in enumerate(names):
+        for gram in trigrams(name):
+            postings[gram].append(i)
+    return {gram: array('I', ids) for gram, ids in postings.items()}
+
+
+MAGIC = b'BBCT'
+VERSION = 1
+_HEADER = struct.Struct('<4sIqqII')
+_GRAM_LENGTH = struct.Struct('<B')
+_POSTINGS = struct.Struct('<cI')
+
+
+def _little_endian(column: array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _encode(ids: array) -> array:
+    deltas = array('I', ids[:1])
+    deltas.extend(map(sub, ids[1:], ids))
+    return array('H', deltas) if max(deltas, default=0) <= 0xFFFF else ids
+
+
+def pack_index(lines: array, postings: Dict[str, array], source) -> bytes:
+    '''Index file of the names on the registry `lines`, for the registry file `source` (mtime_ns, size).'''
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, *source, len(lines), len(postings)))
+    out += _little_endian(lines)
+    encoded = [_encode(ids) for ids in postings.values()]
+    for gram, column in zip(postings, encoded):
+        utf8 = gram.encode('utf-8')
+        out += _GRAM_LENGTH.pack(len(utf8)) + utf8 + _POSTINGS.pack(column.typecode.encode(), len(column))
+    for column in encoded:
+        out += b'\0' * (-len(out) % 4)
+        out += _little_endian(column)
+    return bytes(out)
+
+
+class _Deltas:
+    '''Postings stored as differences, decoded when they're used.'''
+    __slots__ = ('_deltas',)
+
+    def __init__(self, deltas):
+        self._deltas = deltas
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def __iter__(self):
+        return accumulate(self._deltas)
+
+
+class _RegistryNames(Sequence):
+    '''The distinct names of a registry, read from its snapshot when they're scored.'''
+    def __init__(self, registry, lines):
+        self._registry, self._lines = registry, lines
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __getitem__(self, i) -> str:
+        return self._registry.name_at(self._lines[i])
+
+
+def load_index(path, registry) -> TrigramIndex:
+    '''Memory-map the index file of `registry` at `path`. ValueError if it's of another version of it.'''
+    if sys.byteorder == 'big':
+        # the postings are used in place
+        raise ValueError("The trigram index is little endian")
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, mtime_ns, size, count, ngrams = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a trigram index we know")
+    if (mtime_ns, size) != registry.source:
+        raise ValueError(f"{path} is outdated")
+    view, offset = memoryview(mm), _HEADER.size
+    lines = view[offset:offset + 4 * count].cast('I')
+    offset += 4 * count
+    grams = []
+    for _ in range(ngrams):
+        (length,) = _GRAM_LENGTH.unpack_from(mm, offset)
+        offset += _GRAM_LENGTH.size
+        gram = mm[offset:offset + length].decode('utf-8')
+        typecode, n = _POSTINGS.unpack_from(mm, offset + length)
+        offset += length + _POSTINGS.size
+        grams.append((gram, typecode.decode(), n))
+    postings = {}
+    for gram, typecode, n in grams:
+        offset += -offset % 4
+        column = view[offset:offset + n * struct.calcsize(typecode)].cast(typecode)
+        postings[gram] = _Deltas(column) if typecode == 'H' else column
+        offset += n * column.itemsize
+    if offset > len(mm):
+        raise ValueError(f"{path} is truncated")
+    return TrigramIndex(_RegistryNames(registry, lines), postings=postings)
+
+
+def _load_city_index(registry) -> TrigramIndex:
+    if len(registry) <= MAX_CANDIDATES:
+        # every name is scored anyway
+        return TrigramIndex(registry.names())
+    key = os.path.basename(registry.snapshot_path) + '.tri'
+    try:
+        # also marks it as used for the cache's eviction
+        if cache.get(key, with_body=False) is None:
+            raise OSError
+        return load_index(cache.path(key), registry)
+    except (OSError, ValueError, struct.error):
+        pass
+    # registry line of each distinct name, in order of first appearance
+    first = {}
+    for i in range(len(registry)):
+        first.setdefault(registry.name_at(i), i)
+    names = list(first)
+    postings = build_postings(names)
+    # it's memory-mapped, no need to keep a copy in memory too
+    cache.put(key, pack_index(array('I', first.values()), postings, registry.source), in_memory=False)
+    return TrigramIndex(names, postings=postings)
+
+
+# indexes of the loaded city registries, by registry and the (mtime, size) of its file
+_indexes = {}
+
+
+def city_index(registry) -> TrigramIndex:
+    '''Fuzzy index of a `cities.CityRegistry`, built once per version of its file.'''
+    key = (id(registry), registry.source)
+    if key not in _indexes:
+        _indexes[key] = _load_city_index(registry)
+    return _indexes[key]
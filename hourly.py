@@ -1,95 +1,99 @@
-import requests
+from archive import archive
+from cache import cache
+from columns import HourlyColumns, WeatherReport
+import parsed_cache
+from profiling import count, span
+from weather_icons import get_weather_emojis
+
 import json
-import os
-import time
-import tempfile
-from collections import namedtuple, defaultdict
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
-from typing import Dict
-
-WeatherReport = namedtuple(
-    "WeatherReport",
-    [
-        "localDate",
-        "timeslot",
-        "weatherTypeText",
-        "temperatureC",
-        "precipitationProbabilityInPercent",
-        "humidity",
-        "windSpeedKph",
-    ]
-)
+from typing import Dict, List, Optional, Tuple
+
+# The per-day `summary` of the aggregated payload
+DaySummary = namedtuple("DaySummary", ["localDate", "description", "minTempC", "maxTempC"])
 
 #CACHE_FILE = ''
 CACHE_TTL_SEC = 3600
+API_URL = "https://weather-broker-cdn.api.bbci.co.uk/en/forecast/aggregated/{}"
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+# city id -> (digest of the payload, hourly reports, formatted days) for the interactive view
+_hourly = {}
+_hourly_lock = threading.Lock()
 
-def url2file(url) -> str:
+def url2key(url) -> str:
     city_id = url.split('/')[-1]
-    json_hourly = f"weather_hourly_{city_id}.json"
-    return f"{os.path.join(tempfile.gettempdir(), json_hourly)}"
+    return f"weather_hourly_{city_id}.json"
 
 def id2irl(city_id) -> str:
-    return f"https://weather-broker-cdn.api.bbci.co.uk/en/forecast/aggregated/{city_id}" 
+    return API_URL.format(city_id)
 
-def request_weather(url) -> Dict:
+def request_aggregated(city_id, session=None) -> Optional[Tuple[List[DaySummary], HourlyColumns]]:
     '''
-    Requests data from BBC's API. If already requested up to `CACHE_TTL_SEC` ago,
-    read from a cached file.
+    Daily summaries and hourly reports (as returned by `hourly_from_aggregated`)
+    of a city. If the cached payload was parsed before, its parsed snapshot is
+    used and the JSON isn't read or decoded at all. None if there's no data.
     '''
-    cache_file = url2file(url)
-    # if already cached read from it
-    if os.path.exists(cache_file):
-        file_age = time.time() - os.path.getmtime(cache_file)
-        if file_age < CACHE_TTL_SEC:
-            with open(cache_file, 'r') as f:
-                return json.load(f)
-    # else cache it
-    headers = {"User-Agent": "Mozilla/5.0"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        with open(cache_file, 'w') as f:
-            json.dump(data, f)
-        return data
-    else:
-        print(f"Failed to fetch data. HTTP status code: {response.status_code}")
-        return None
-
-
-def request_hourly(city_id) -> WeatherReport:
     url = id2irl(city_id)
-    data = request_weather(url)
-    if not data:
-        return defaultdict(list)
-    forecasts = data.get("forecasts", [])
-    weather_data = defaultdict(list)
-
-    for iday, forecast in enumerate(forecasts):
-        reports = forecast.get("detailed", {}).get("reports", [])
-        for ihour, report in enumerate(reports):
-            try:
-                # you can inspect the API yourself and grab more data here
-                localDate = report["localDate"]
-                timeslot = report["timeslot"]
-                weatherTypeText = report["weatherTypeText"]
-                temperatureC = report["temperatureC"]
-                precipitationProbabilityInPercent = report["precipitationProbabilityInPercent"]
-                humidity = report["humidity"]
-                windSpeedKph = report["windSpeedKph"]
-
-                weather_report = WeatherReport(
-                    localDate=localDate,
-                    timeslot=timeslot,
-                    weatherTypeText=weatherTypeText,
-                    temperatureC=temperatureC,
-                    precipitationProbabilityInPercent=precipitationProbabilityInPercent,
-                    humidity=humidity,
-                    windSpeedKph=windSpeedKph
-                )
-                weather_data[localDate].append(weather_report)
-            except KeyError:
-                pass
-    return weather_data
+    key = url2key(url)
+    entry = cache.fetch(key, url, CACHE_TTL_SEC, HEADERS, session, with_body=False)
+    if entry is None:
+        return None
+    with span('snapshot_load'):
+        parsed = parsed_cache.load(key, entry.digest)
+    if parsed:
+        count('parsed.snapshot_hits')
+        days, weather_data = parsed
+        return [DaySummary._make(d) for d in days], weather_data
+    if entry.body is None:
+        entry = cache.get(key) or cache.revalidate(key, url, HEADERS, session, conditional=False)
+        if entry is None:
+            return None
+    with span('parse_json'):
+        try:
+            data = json.loads(entry.body)
+        except ValueError:
+            cache.warn(f"Invalid JSON from {url}")
+            return None
+        days, weather_data = summary_from_aggregated(data), hourly_from_aggregated(data)
+    with span('snapshot_store'):
+        parsed_cache.store(key, entry.digest, days, weather_data)
+    with span('archive'):
+        archive.record(city_id, entry.stored_at, entry.digest, days, weather_data)
+    return days, weather_data
+
+
+def request_hourly(city_id, session=None) -> HourlyColumns:
+    aggregated = request_aggregated(city_id, session)
+    if not aggregated:
+        return HourlyColumns()
+    return aggregated[1]
+
+
+def summary_from_aggregated(data) -> List[DaySummary]:
+    days = []
+    for forecast in data.get("forecasts", []):
+        report = forecast.get("summary", {}).get("report", {})
+        if "localDate" not in report:
+            continue
+        descr = report.get("enhancedWeatherDescription") or report.get("weatherTypeText") or 'N/A'
+        days.append(DaySummary(report["localDate"], descr, report.get("minTempC"), report.get("maxTempC")))
+    return days
+
+
+def hourly_from_aggregated(data) -> HourlyColumns:
+    def reports():
+        for forecast in data.get("forecasts", []):
+            for report in forecast.get("detailed", {}).get("reports", []):
+                try:
+                    # you can inspect the API yourself and grab more data here
+                    yield (report["localDate"], report["timeslot"], report["weatherTypeText"],
+                           report["temperatureC"], report["precipitationProbabilityInPercent"],
+                           report["humidity"], report["windSpeedKph"])
+                except KeyError:
+                    pass
+    return HourlyColumns.from_reports(reports())
 
 
 def draw_bar(from_, to_, value, bar_width=20) -> str:
@@ -104,32 +108,75 @@ def draw_bar(from_, to_, value, bar_width=20) -> str:
     return bar
 
 
-def fmt_weather_data(data, from_, to_) -> str:
+def fmt_weather_data(data, from_, to_, icon=None) -> str:
     hour = data.timeslot
     temp = data.temperatureC
     temp_bar = draw_bar(from_, to_, temp)
     humid = data.humidity
     wspeed = data.windSpeedKph
-    text = data.weatherTypeText
+    text = data.weatherTypeText if icon is None else f"{icon} {data.weatherTypeText}"
     ret = f"{hour} \t {temp_bar} \t {temp} °C \t {humid} % \t {wspeed} kph \t {text}"
     return ret
 
 
+def load_hourly(city_id) -> Tuple[HourlyColumns, Dict[str, str]]:
+    '''
+    Hourly reports of a city and its memo of formatted days, loaded once per
+    version of the cached payload: they're reloaded as soon as it's replaced,
+    e.g. refreshed by the scheduler or another process.
+    '''
+    url = id2irl(city_id)
+    # held while loading so a prefetch and a keypress don't both load the city
+    with _hourly_lock:
+        entry = cache.fetch(url2key(url), url, CACHE_TTL_SEC, HEADERS, with_body=False)
+        if entry is None:
+            return HourlyColumns(), {}
+        if city_id in _hourly:
+            digest, weather_data, formatted = _hourly[city_id]
+            if digest == entry.digest:
+                return weather_data, formatted
+        weather_data, formatted = request_hourly(city_id), {}
+        # don't hold on to a failed request
+        if weather_data:
+            _hourly[city_id] = (entry.digest, weather_data, formatted)
+        return weather_data, formatted
+
+
+def prefetch_hourly(city_id) -> threading.Thread:
+    '''Load and format every day of the hourly forecast in the background.'''
+    def warm():
+        weather_data, formatted = load_hourly(city_id)
+        for target_date in list(weather_data):
+            if target_date not in formatted:
+                formatted[target_date] = fmt_hourly_reports(weather_data, target_date)
+
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
+
+
 def fmt_day_hourly(city_id, days_from_now=0) -> str:
-    weather_data = request_hourly(city_id)
+    weather_data, formatted = load_hourly(city_id)
     target_date = (datetime.now() + timedelta(days=days_from_now)).strftime('%Y-%m-%d')
+    if target_date not in formatted:
+        with span('fmt_hourly'):
+            formatted[target_date] = fmt_hourly_reports(weather_data, target_date)
+    return formatted[target_date]
+
+
+def fmt_hourly_reports(weather_data, target_date) -> str:
     ret = ''
 
     if target_date in weather_data:
+        if not isinstance(weather_data, HourlyColumns):
+            weather_data = HourlyColumns.from_reports(weather_data[target_date])
+        # the bars span the day's temperatures, within these limits
         # change these if you live in a very cold/hot place
-        temp_min, temp_max = -40, 55
-        for report in weather_data[target_date]:
-            # grab the min and mxx temperature to adjust the steps in the bar
-            if report.temperatureC > temp_min:
-                temp_min = report.temperatureC
-            if report.temperatureC < temp_max:
-                temp_max = report.temperatureC
-        temp_min, temp_max = temp_max, temp_min
-        for report in weather_data[target_date]:
-            ret += fmt_weather_data(report, temp_min, temp_max) + '\n'
+        lowest, highest = weather_data.day_min(target_date), weather_data.day_max(target_date)
+        temp_min = 55 if lowest is None else min(lowest, 55)
+        temp_max = -40 if highest is None else max(highest, -40)
+        reports = weather_data[target_date]
+        icons = get_weather_emojis([report.weatherTypeText for report in reports])
+        for report, icon in zip(reports, icons):
+            ret += fmt_weather_data(report, temp_min, temp_max, icon) + '\n'
     return ret
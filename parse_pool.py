@@ -0,0 +1,197 @@
+'''
+Batch fetching with the parsing done in worker processes. Decoding the
+aggregated JSON of hundreds of freshly downloaded cities (or scraping their
+pages) is CPU bound, and in `batch.fetch_many`'s threads it all runs on one
+core. Here the threads only bring the payloads into the cache; the cities
+whose payload has no parsed snapshot yet are sent to a process pool in
+chunks, as cache file paths, and each worker sends back the packed snapshot
+(see `parsed_cache.pack`), a few KB per city.
+'''
+from batch import DEFAULT_CONCURRENCY, CityForecast, fetch_city
+from transport import make_session
+from cache import cache
+from daily import (PAGE_TTL_SEC, archive_page, daily_from_summaries, id2page, parse_page, scrape,
+                   weather_from_snapshot)
+from hourly import (CACHE_TTL_SEC, HEADERS, DaySummary, hourly_from_aggregated, id2irl,
+                    summary_from_aggregated, url2key)
+from archive import archive
+import parsed_cache
+from profiling import count, span
+from weather_icons import get_weather_emoji
+
+import hashlib
+import json
+import os
+import struct
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+# cities per task sent to a worker process
+DEFAULT_CHUNKSIZE = 8
+
+# A payload to parse in a worker: `kind` is 'api' or 'page'
+ParseJob = namedtuple('ParseJob', ['kind', 'city_id', 'key', 'path', 'entry'])
+
+
+def parse_file(kind, path) -> Optional[bytes]:
+    '''
+    Packed snapshot of the cached payload at `path`, tied to the digest of
+    what was actually read. None if it's gone or can't be parsed. Runs in
+    the worker processes, so it doesn't touch the cache or the archive.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha1(body).digest()
+        if kind == 'page':
+            return parsed_cache.pack(digest, parse_page(body.decode('utf-8', errors='replace')))
+        data = json.loads(body)
+        return parsed_cache.pack(digest, summary_from_aggregated(data), hourly_from_aggregated(data))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def _parse_chunk(jobs) -> List[Optional[bytes]]:
+    return [parse_file(kind, path) for kind, path in jobs]
+
+
+def _needs_parsing(key, entry) -> bool:
+    # the body may have been dropped (it was parsed) or evicted meanwhile
+    return parsed_cache.load(key, entry.digest) is None and os.path.exists(cache.path(key))
+
+
+def prepare(city_id, session=None, use_emojis=True):
+    '''
+    Bring a city's payload into the cache. Returns (forecast, None) if
+    there's nothing worth a worker, e.g. it was parsed before, otherwise
+    (None, the job to parse). Runs in the fetch threads.
+    '''
+    url = id2irl(city_id)
+    key = url2key(url)
+    entry = cache.fetch(key, url, CACHE_TTL_SEC, HEADERS, session, with_body=False)
+    if entry is not None:
+        if _needs_parsing(key, entry):
+            return None, ParseJob('api', city_id, key, cache.path(key), entry)
+        # cheap now, it reads the snapshot
+        return fetch_city(city_id, session, use_emojis), None
+    # no API data, the daily page is all we can get
+    page_key = f"{city_id}.html"
+    entry = cache.fetch(page_key, id2page(city_id), PAGE_TTL_SEC, session=session, with_body=False)
+    if entry is not None and _needs_parsing(page_key, entry):
+        return None, ParseJob('page', city_id, page_key, cache.path(page_key), entry)
+    return CityForecast(city_id, scrape(id2page(city_id), use_emojis, session=session), {}, None), None
+
+
+def finish(job: ParseJob, blob: Optional[bytes], session=None, use_emojis=True) -> CityForecast:
+    '''Store and archive what a worker parsed and turn it into the city's forecast.'''
+    if blob is None:
+        raise ValueError(f"Couldn't parse the cached {job.key}")
+    digest, days, hours = parsed_cache.unpack(blob)
+    digest = digest.hex()
+    if digest == job.entry.digest:
+        parsed_cache.store_packed(job.key, blob)
+    else:
+        # the payload was replaced while the worker read it: the snapshot is
+        # of the new one, which has to stay
+        cache.put(job.key + parsed_cache.PARSED_EXT, blob)
+    entry = job.entry._replace(digest=digest)
+    if job.kind == 'page':
+        daily = weather_from_snapshot(days)
+        archive_page(job.city_id, entry, daily)
+        if use_emojis:
+            daily = [w._replace(descr=f"{get_weather_emoji(w.descr)} {w.descr}") for w in daily]
+        return CityForecast(job.city_id, daily, {}, None)
+    days = [DaySummary._make(d) for d in days]
+    archive.record(job.city_id, entry.stored_at, digest, days, hours)
+    daily = daily_from_summaries(days, use_emojis)
+    if not daily:
+        daily = scrape(id2page(job.city_id), use_emojis, session=session)
+    return CityForecast(job.city_id, daily, hours, None)
+
+
+def _chunks(items: Iterable, size) -> Iterator[List]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fetch_many(city_ids, workers=None, concurrency=DEFAULT_CONCURRENCY, session=None, use_emojis=True,
+               chunksize=DEFAULT_CHUNKSIZE) -> Iterator[CityForecast]:
+    '''
+    `batch.fetch_many` parsing with `workers` processes (default one per
+    core). Cities are fetched `chunksize` at a time by `concurrency` threads
+    while the workers parse the previous chunks, at most two per worker
+    queued, and yielded as each chunk is done.
+    '''
+    workers = workers or os.cpu_count() or 1
+    own_session = session is None
+    if own_session:
+        session = make_session(concurrency)
+    # start the workers before any thread, forking a process that has
+    # threads holding locks can leave the child stuck on them
+    processes = ProcessPoolExecutor(max_workers=workers)
+    processes.submit(int).result()
+    threads = ThreadPoolExecutor(max_workers=concurrency)
+
+    def fetch(city_id):
+        if isinstance(city_id, CityForecast):
+            # a line of the city list that didn't match a city
+            return city_id, None
+        try:
+            return prepare(city_id, session, use_emojis)
+        except Exception as e:
+            return CityForecast(city_id, [], {}, e), None
+
+    def done(parsing):
+        future, jobs = parsing
+        try:
+            with span('pool.wait'):
+                blobs = future.result()
+        # e.g. a worker was killed
+        except Exception as e:
+            blobs = [e] * len(jobs)
+        for job, blob in zip(jobs, blobs):
+            try:
+                city = blob if isinstance(blob, Exception) else finish(job, blob, session, use_emojis)
+            except Exception as e:
+                city = e
+            if isinstance(city, Exception):
+                city = CityForecast(job.city_id, [], {}, city)
+            yield city
+
+    parsing = deque()
+    finished = False
+    try:
+        for chunk in _chunks(city_ids, chunksize):
+            jobs = []
+            for city, job in threads.map(fetch, chunk):
+                if job is None:
+                    yield city
+                else:
+                    jobs.append(job)
+            if jobs:
+                count('pool.parsed', len(jobs))
+                future = processes.submit(_parse_chunk, [(job.kind, job.path) for job in jobs])
+                parsing.append((future, jobs))
+            while parsing and (parsing[0][0].done() or len(parsing) > 2 * workers):
+                yield from done(parsing.popleft())
+        while parsing:
+            yield from done(parsing.popleft())
+        finished = True
+    finally:
+        if finished:
+            # nothing's left running: wait for the pool to stop, exiting while
+            # it's stopping can fail in its exit handler
+            threads.shutdown()
+            processes.shutdown()
+        else:
+            # the caller stopped early or something failed, drop what's queued
+            threads.shutdown(wait=False, cancel_futures=True)
+            processes.shutdown(wait=False, cancel_futures=True)
+        if own_session:
+            session.close()
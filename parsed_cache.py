@@ -0,0 +1,166 @@
+'''
+Compact binary snapshots of already parsed forecasts, so that a warm start
+doesn't re-read and re-parse the HTML page or the aggregated JSON.
+
+A snapshot is tied to the payload it was parsed from by the payload's SHA-1,
+which the raw cache keeps in its `.meta` file. Layout (little endian):
+
+    magic 'BBCP' | version u8 | sha1 20s
+    string table: count u16, then (length u16, utf-8 bytes) per string
+    days:  count u16, then (str u16, str u16, temp i16, temp i16) per day
+    hours: count u16, then (date str u16, count u16) per date, followed by
+           the `columns.HourlyColumns` columns of all the reports one after
+           the other: minutes u16, text str u16, temperature i16,
+           precipitation i16, humidity i16, wind speed i16
+
+Strings are indices into the table and missing temperatures/values are -32768.
+The hourly columns are read back as arrays without touching each report.
+'''
+from cache import cache
+from columns import HourlyColumns, MISSING, VALUE_COLUMNS
+
+import struct
+import sys
+from array import array
+from typing import List, Optional, Tuple
+
+MAGIC = b'BBCP'
+VERSION = 2
+PARSED_EXT = '.bin'
+
+_HEADER = struct.Struct('<4sB20s')
+_COUNT = struct.Struct('<H')
+_DAY = struct.Struct('<HHhh')
+_DATE = struct.Struct('<HH')
+
+
+def _value(x) -> int:
+    # struct refuses anything that's not an int that fits, so we never store garbage
+    return MISSING if x is None or x == 'N/A' else x
+
+
+def _unvalue(x):
+    return None if x == MISSING else x
+
+
+def _column_bytes(column: array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_column(typecode, blob, offset, count) -> Tuple[array, int]:
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    if end > len(blob):
+        raise ValueError("Truncated snapshot")
+    column.frombytes(blob[offset:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, end
+
+
+def pack(digest: bytes, days: List[Tuple] = (), hours: HourlyColumns = None) -> bytes:
+    '''
+    `days` are (str, str, temp, temp) rows and `hours` the hourly reports.
+    Raises struct.error if a value doesn't fit.
+    '''
+    hours = hours if hours is not None else HourlyColumns()
+    strings, index = [], {}
+
+    def intern(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    body = [_COUNT.pack(len(days))]
+    for s1, s2, t1, t2 in days:
+        body.append(_DAY.pack(intern(s1), intern(s2), _value(t1), _value(t2)))
+    body.append(_COUNT.pack(len(hours.bounds)))
+    for date, (start, stop) in hours.bounds.items():
+        body.append(_DATE.pack(intern(date), stop - start))
+    texts = [intern(text) for text in hours.texts]
+    body.append(_column_bytes(hours.minutes))
+    body.append(_column_bytes(array('H', (texts[i] for i in hours.types))))
+    for name in VALUE_COLUMNS:
+        body.append(_column_bytes(getattr(hours, name)))
+    table = [_COUNT.pack(len(strings))]
+    for s in strings:
+        encoded = s.encode('utf-8')
+        table.append(_COUNT.pack(len(encoded)) + encoded)
+    return _HEADER.pack(MAGIC, VERSION, digest) + b''.join(table) + b''.join(body)
+
+
+def unpack(blob: bytes) -> Tuple[bytes, List[Tuple], HourlyColumns]:
+    '''Inverse of `pack`: (sha1, days, hours). Raises ValueError if it's not a snapshot we know.'''
+    magic, version, digest = _HEADER.unpack_from(blob, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a parsed forecast snapshot or unsupported version")
+    offset = _HEADER.size
+    (nstrings,) = _COUNT.unpack_from(blob, offset)
+    offset += _COUNT.size
+    strings = []
+    for _ in range(nstrings):
+        (length,) = _COUNT.unpack_from(blob, offset)
+        offset += _COUNT.size
+        strings.append(blob[offset:offset + length].decode('utf-8'))
+        offset += length
+    (ndays,) = _COUNT.unpack_from(blob, offset)
+    offset += _COUNT.size
+    days = []
+    for s1, s2, t1, t2 in _DAY.iter_unpack(blob[offset:offset + ndays * _DAY.size]):
+        days.append((strings[s1], strings[s2], _unvalue(t1), _unvalue(t2)))
+    offset += ndays * _DAY.size
+    (ndates,) = _COUNT.unpack_from(blob, offset)
+    offset += _COUNT.size
+    dates = []
+    for _ in range(ndates):
+        idate, nreports = _DATE.unpack_from(blob, offset)
+        offset += _DATE.size
+        dates.append((strings[idate], nreports))
+    nreports = sum(n for _, n in dates)
+    columns = {}
+    for name, typecode in [('minutes', 'H'), ('types', 'H')] + [(name, 'h') for name in VALUE_COLUMNS]:
+        columns[name], offset = _read_column(typecode, blob, offset, nreports)
+    # the text column points into the string table, so that's the texts table
+    hours = HourlyColumns(dates, strings, **columns)
+    return digest, days, hours
+
+
+def load(key, digest: Optional[str]):
+    '''Parsed (days, hours) of the payload cached under `key` if its snapshot matches `digest`.'''
+    if digest is None:
+        return None
+    entry = cache.get(key + PARSED_EXT)
+    if entry is None:
+        return None
+    try:
+        stored_digest, days, hours = unpack(entry.body)
+    except (ValueError, struct.error):
+        return None
+    if stored_digest.hex() != digest:
+        return None
+    return days, hours
+
+
+def store(key, digest: Optional[str], days=(), hours=None) -> bool:
+    '''
+    Save a snapshot of what was parsed out of the payload cached under `key`
+    and drop the payload itself, only its validators are still needed.
+    '''
+    if digest is None:
+        return False
+    try:
+        blob = pack(bytes.fromhex(digest), days, hours)
+    except struct.error:
+        return False
+    store_packed(key, blob)
+    return True
+
+
+def store_packed(key, blob: bytes):
+    '''`store` for a snapshot that was packed already, e.g. in another process.'''
+    cache.put(key + PARSED_EXT, blob)
+    cache.drop_body(key)
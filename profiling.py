@@ -0,0 +1,106 @@
+'''
+Where the time goes: named spans around the stages of a run and counters
+(cache hits, bytes downloaded, frames drawn...). Off unless `enable()` is
+called, e.g. by `--profile`; then `span` and `count` are a flag check and
+return. Results are a summary table or a Chrome trace (chrome://tracing,
+ui.perfetto.dev).
+'''
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import List, Tuple
+
+enabled = False
+# (name, thread id, start, duration) in perf_counter seconds
+_spans: List[Tuple[str, int, float, float]] = []
+# (name, time, value) of every counter change, for the trace
+_samples: List[Tuple[str, float, int]] = []
+counters = Counter()
+_lock = threading.Lock()
+_NULL = contextlib.nullcontext()
+_origin = time.perf_counter()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        with _lock:
+            _spans.append((self.name, threading.get_ident(), self.start, end - self.start))
+
+
+def span(name):
+    '''`with span('stage'):` times the block if profiling is on.'''
+    if not enabled:
+        return _NULL
+    return _Span(name)
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        counters[name] += n
+        _samples.append((name, time.perf_counter(), counters[name]))
+
+
+def enable(trace_path=None):
+    '''
+    Start recording. At exit print the summary to stderr and, if
+    `trace_path` is given, write the Chrome trace there.
+    '''
+    global enabled
+    enabled = True
+
+    def report():
+        print(summary(), file=sys.stderr)
+        if trace_path:
+            write_trace(trace_path)
+            print(f"Trace written to {trace_path}", file=sys.stderr)
+
+    atexit.register(report)
+
+
+def summary() -> str:
+    with _lock:
+        spans, totals = list(_spans), dict(counters)
+    stats = defaultdict(list)
+    for name, _, _, duration in spans:
+        stats[name].append(duration * 1e3)
+    lines = [f"{'span':<28} {'calls':>6} {'total (ms)':>11} {'mean (ms)':>10} {'max (ms)':>10}"]
+    for name, times in sorted(stats.items(), key=lambda item: -sum(item[1])):
+        lines.append(f"{name:<28} {len(times):>6} {sum(times):>11.2f} {sum(times) / len(times):>10.2f} "
+                     f"{max(times):>10.2f}")
+    if totals:
+        lines.append('')
+        lines.append(f"{'counter':<28} {'value':>11}")
+        for name, value in sorted(totals.items()):
+            lines.append(f"{name:<28} {value:>11}")
+    return "\n".join(lines)
+
+
+def write_trace(path):
+    '''Everything recorded as Chrome trace events.'''
+    with _lock:
+        spans, samples = list(_spans), list(_samples)
+    pid = os.getpid()
+    events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+               'ts': (start - _origin) * 1e6, 'dur': duration * 1e6}
+              for name, tid, start, duration in spans]
+    events += [{'name': name, 'ph': 'C', 'pid': pid, 'ts': (at - _origin) * 1e6, 'args': {name: value}}
+               for name, at, value in samples]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
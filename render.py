@@ -0,0 +1,127 @@
+from profiling import count
+
+import os
+import sys
+import time
+from typing import List
+
+CLEAR = "\x1b[2J\x1b[H"
+# lines of a card, see `create_card`
+CARD_HEIGHT = 6
+# title and its underline
+HEADER_HEIGHT = 2
+
+
+def move_to(line, column=1) -> str:
+    return f"\x1b[{line};{column}H"
+
+
+def clear_screen(out=None):
+    '''Clear the terminal with an escape sequence instead of spawning `clear`.'''
+    out = out or sys.stdout
+    out.write(CLEAR)
+    out.flush()
+
+
+def create_card(weather, highlighted=False, card_width=30) -> str:
+    """Generate a single card as a string."""
+    description = weather.descr
+    temp_range = f"{weather.temp_low} to {weather.temp_high} °C".center(card_width - 2)
+    if not highlighted:
+        card = (
+            f"┌{'─' * (card_width - 2)}┐\n"  # Top border
+            f"│{weather.date.center(card_width - 2)}│\n"  # Date
+            f"│{description[:card_width-4].center(card_width - 2)}│\n"  # Description
+            f"│{description[card_width-4:].center(card_width - 2)}│\n"  # Description
+            f"│{temp_range}│\n"  # Temp range
+            f"└{'─' * (card_width - 2)}┘"  # Bottom border
+        )
+    else:
+        card = (
+            f"▛{'▀' * (card_width - 2)}▜\n"  # Top border
+            f"▌{weather.date.center(card_width - 2)}▐\n"  # Date
+            f"▌{description[:card_width-4].center(card_width - 2)}▐\n"  # Description
+            f"▌{description[card_width-4:].center(card_width - 2)}▐\n"  # Description
+            f"▌{temp_range}▐\n"  # Temp range
+            f"▙{'▄' * (card_width - 2)}▟"  # Bottom border
+        )
+    return card
+
+
+class CardRenderer:
+    '''
+    Draws the daily cards and afterwards only rewrites what changed. Both
+    looks (plain and highlighted) of every card are built once per dataset
+    and moving the highlight rewrites just the card rows it left and entered,
+    placing the cursor with ANSI escapes. Rows are rewritten whole because
+    emojis make the display width of a line differ from its length.
+    The last line shows how long the latest frame took.
+    '''
+    def __init__(self, title, weather_data, footer='', card_width=30, cards_per_row=4, out=None):
+        self.footer = footer
+        self.card_width = card_width
+        self.cards_per_row = cards_per_row
+        self.out = out or sys.stdout
+        self.frames = 0
+        self.last_frame_ms = 0.0
+        if os.name == 'nt':
+            os.system('')  # enables escape sequences on the Windows console
+        self.set_data(title, weather_data)
+
+    def set_data(self, title, weather_data):
+        self.title = title
+        self.weather_data = weather_data
+        self._cards = [(create_card(w, False, self.card_width).splitlines(),
+                        create_card(w, True, self.card_width).splitlines()) for w in weather_data]
+        # nothing on screen for this dataset yet
+        self._highlighted = None
+
+    def _row_lines(self, irow, icard) -> List[str]:
+        first = irow * self.cards_per_row
+        cards = [self._cards[i][i == icard] for i in range(first, min(first + self.cards_per_row, len(self._cards)))]
+        return [" ".join(card[line] for card in cards) for line in range(CARD_HEIGHT)]
+
+    def _row_top(self, irow) -> int:
+        # 1-based terminal line; every row of cards is followed by a blank line
+        return HEADER_HEIGHT + 1 + irow * (CARD_HEIGHT + 1)
+
+    def lines(self, icard=None) -> List[str]:
+        '''Title, cards (`icard` highlighted) and footer, line by line.'''
+        lines = [f" {self.title}", f"└{'─' * (len(self.title))}┘"]
+        nrows = (len(self._cards) + self.cards_per_row - 1) // self.cards_per_row
+        for irow in range(nrows):
+            lines += self._row_lines(irow, icard) + ['']
+        return lines + self.footer.splitlines()
+
+    def draw(self, icard):
+        '''Clear the screen and draw everything.'''
+        start = time.perf_counter()
+        lines = self.lines(icard)
+        self._status_line = len(lines) + 1
+        self.out.write(CLEAR + "\n".join(lines) + "\n")
+        self._highlighted = icard
+        self._frame_done(start, 'full')
+
+    def update(self, icard):
+        '''Move the highlight to card `icard`, drawing as little as possible.'''
+        if self._highlighted is None:
+            return self.draw(icard)
+        if icard == self._highlighted:
+            return
+        start = time.perf_counter()
+        buf = []
+        for irow in sorted({self._highlighted // self.cards_per_row, icard // self.cards_per_row}):
+            top = self._row_top(irow)
+            for i, line in enumerate(self._row_lines(irow, icard)):
+                buf.append(f"{move_to(top + i)}{line}\x1b[K")
+        self.out.write("".join(buf))
+        self._highlighted = icard
+        self._frame_done(start, 'partial')
+
+    def _frame_done(self, start, kind):
+        count(f'frames.{kind}')
+        self.frames += 1
+        self.last_frame_ms = (time.perf_counter() - start) * 1e3
+        self.out.write(f"{move_to(self._status_line)}frame {self.frames}: {kind} redraw "
+                       f"in {self.last_frame_ms:.2f} ms\x1b[K")
+        self.out.flush()
@@ -0,0 +1,102 @@
+from cache import cache
+from hourly import CACHE_TTL_SEC, HEADERS, id2irl, url2key, request_aggregated
+from daily import PAGE_TTL_SEC, id2page, scrape
+
+import contextlib
+import random
+import sys
+import threading
+import time
+from typing import Iterable
+
+# refresh this long before the cached data expires
+REFRESH_LEAD_SEC = 5 * 60
+# plus a random extra up to this, so many cities don't refresh all at once
+REFRESH_JITTER_SEC = 2 * 60
+# wait before trying again after a failed refresh
+RETRY_SEC = 5 * 60
+
+
+class RefreshScheduler:
+    '''
+    Keeps the cached forecasts of a set of cities warm: each one is refreshed
+    through the shared cache (a 304 when it hasn't changed) and re-parsed
+    shortly before its TTL runs out, so readers never wait for the network.
+    Refreshes run one at a time and when several are due the most read
+    cities go first: reads by this process, then the last time any process
+    read the city. The scheduler's own cache lookups don't count as reads.
+    '''
+    def __init__(self, city_ids: Iterable, lead=REFRESH_LEAD_SEC, jitter=REFRESH_JITTER_SEC,
+                 session=None, verbose=False):
+        self.city_ids = list(dict.fromkeys(city_ids))
+        self.lead = lead
+        self.jitter = jitter
+        self.session = session
+        self.verbose = verbose
+        self.refreshes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._next = {city_id: self._due(city_id) for city_id in self.city_ids}
+
+    def _due(self, city_id) -> float:
+        '''When the city should next be refreshed, now if it's not cached.'''
+        with cache.quiet():
+            entry = cache.get(url2key(id2irl(city_id)), with_body=False)
+        if entry is None:
+            return time.time()
+        return entry.stored_at + CACHE_TTL_SEC - self.lead - random.uniform(0, self.jitter)
+
+    def _priority(self, city_id):
+        key = url2key(id2irl(city_id))
+        return cache.reads[key], cache.last_used(key)
+
+    def refresh(self, city_id):
+        '''
+        Revalidate and re-parse a city's aggregated payload, and its page if
+        it was ever needed. Failures are only reported if `verbose`.
+        '''
+        with cache.quiet(), contextlib.nullcontext() if self.verbose else cache.silent():
+            self._refresh(city_id)
+
+    def _refresh(self, city_id):
+        url = id2irl(city_id)
+        key = url2key(url)
+        entry = cache.revalidate(key, url, HEADERS, self.session)
+        # parse now so the next reader finds the snapshot
+        request_aggregated(city_id, self.session)
+        page_key = f"{city_id}.html"
+        page_entry = cache.get(page_key, with_body=False)
+        if page_entry and cache.age(page_entry) > PAGE_TTL_SEC - self.lead - self.jitter:
+            cache.revalidate(page_key, id2page(city_id), session=self.session)
+            scrape(id2page(city_id), session=self.session)
+        self.refreshes += 1
+        fresh = entry is not None and cache.age(entry) < CACHE_TTL_SEC - self.lead
+        self._next[city_id] = self._due(city_id) if fresh else time.time() + RETRY_SEC
+        if self.verbose:
+            print(f"Refreshed {city_id}, next at {time.strftime('%H:%M:%S', time.localtime(self._next[city_id]))}")
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            now = time.time()
+            due = [city_id for city_id, at in self._next.items() if at <= now]
+            if not due:
+                self._stop.wait(min(self._next.values(), default=now + RETRY_SEC) - now)
+                continue
+            city_id = max(due, key=self._priority)
+            try:
+                self.refresh(city_id)
+            except Exception as e:
+                if self.verbose:
+                    print(f"Failed to refresh {city_id}: {e}", file=sys.stderr)
+                self._next[city_id] = time.time() + RETRY_SEC
+
+    def start(self) -> 'RefreshScheduler':
+        '''Run in a daemon thread.'''
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
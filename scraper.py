@@ -1,25 +1,22 @@
 #!/usr/bin/env python3
 
-from hourly import fmt_day_hourly
-from closest_city import find_closest_city 
+from cache import cache
+from hourly import fmt_day_hourly, prefetch_hourly
+from daily import get_daily
+from render import CardRenderer, create_card, clear_screen
+from cities import CityRegistry
+from utils import get_city_id
+import profiling
+from profiling import span
+# closest_city (geopy), batch (asyncio), scheduler and pynput are imported
+# only by the modes that use them, they're most of the start-up time
 
-from bs4 import BeautifulSoup
 import wcwidth
-from pynput import keyboard
 
-from collections import namedtuple
-import sys
-import time
-from difflib import get_close_matches
-import re
 import os
-from datetime import datetime, timedelta
-import requests
-from typing import List
-import threading
-import time
 import sys
-import tempfile
+import threading
+import argparse
 
 # select which weather card is highlighted
 icard=0
@@ -28,40 +25,14 @@ print_hourly = False
 city_id = ''
 running = True
 city_name = ''
-
-def get_weather_emoji(description: str) -> str:
-    description = description.lower()
-    if re.search(r'\bsun\w*\b', description) and re.search(r'\bcloud\w*\b', description):
-        return "🌤"
-    elif re.search(r'\bcloud\w*\b', description) and re.search(r'\brain\w*\b', description):
-        return "⛆"
-    elif re.search(r'\bthunder\b|\blightning\b', description) and re.search(r'\brain\b|\bstorm\b', description):
-        return "⛈"
-    elif re.search(r'\bthunder\b|\blightning\b', description):
-        return "🌩"
-    elif re.search(r'\bsnow\b', description):
-        return "❄"
-    elif re.search(r'\bmist\b|\bfog\b', description):
-        return "🌫"
-    elif re.search(r'\bcloud\w*\b', description):
-        return '☁'
-    elif re.search(r'\brain\b', description) or re.search(r'\bdrizzle\b', description):
-        return '⛆'
-    elif re.search(r'\bsleet\b', description):
-        return '❅'
-    elif re.search(r'\bsun\w*\b|\bclear\b', description):
-        return '☀'
-    return "?"
+# set by the keyboard listener to wake up the main loop
+redraw = threading.Event()
+# how often (s) the main loop checks for a refreshed forecast
+DATA_REFRESH_SEC = 60
 
 def id2city(city_id: str) -> str:
-    with open('city_ids.dat') as f:
-        lines = f.readlines()
-        for l in lines:
-            if l.split(':')[1].strip() == str(city_id):
-                city_name = l.split(':')[0].strip()
-                return city_name
-    return 'N/A'
-    
+    return CityRegistry.load().name_of(city_id) or 'N/A'
+
 
 def print_weather_cards(weather_data, card_width=30, cards_per_row=4):
     """
@@ -90,32 +61,8 @@ def print_weather_cards(weather_data, card_width=30, cards_per_row=4):
         truncated = "".join(result)
         return pad_string(truncated, target_width)
 
-    def create_card(weather, icard_current):
-        """Generate a single card as a string."""
-        description = weather.descr
-        temp_range = f"{weather.temp_low} to {weather.temp_high} °C".center(card_width - 2)
-        if icard_current != icard: # not highlighted
-            card = (
-                f"┌{'─' * (card_width - 2)}┐\n"  # Top border
-                f"│{weather.date.center(card_width - 2)}│\n"  # Date
-                f"│{description[:card_width-4].center(card_width - 2)}│\n"  # Description
-                f"│{description[card_width-4:].center(card_width - 2)}│\n"  # Description
-                f"│{temp_range}│\n"  # Temp range
-                f"└{'─' * (card_width - 2)}┘"  # Bottom border
-            )
-        else:
-            card = (
-                f"▛{'▀' * (card_width - 2)}▜\n"  # Top border
-                f"▌{weather.date.center(card_width - 2)}▐\n"  # Date
-                f"▌{description[:card_width-4].center(card_width - 2)}▐\n"  # Description
-                f"▌{description[card_width-4:].center(card_width - 2)}▐\n"  # Description
-                f"▌{temp_range}▐\n"  # Temp range
-                f"▙{'▄' * (card_width - 2)}▟"  # Bottom border
-            )
-        return card
-
     if not print_hourly:
-        os.system("cls" if os.name == "nt" else "clear")  # Clear screen
+        clear_screen()
     rows = []
     for i in range(0, len(weather_data), cards_per_row):
         row = weather_data[i:i + cards_per_row]
@@ -127,7 +74,8 @@ def print_weather_cards(weather_data, card_width=30, cards_per_row=4):
         print(f"└{'─' * (len(city_name))}┘")
     # print weather cards
     for irow, row in enumerate(rows):
-        card_lines = [create_card(weather, irow*cards_per_row + icol).splitlines() for icol ,weather in enumerate(row)]
+        card_lines = [create_card(weather, irow*cards_per_row + icol == icard, card_width).splitlines()
+                      for icol ,weather in enumerate(row)]
         for line_idx in range(len(card_lines[0])):
             if not print_hourly:
                 print(" ".join(card[line_idx] for card in card_lines))
@@ -154,110 +102,6 @@ def format_keys():
     )
     return key_layout
 
-def is_file_outdated(file_path, max_age_hours=2) -> bool:
-    if os.path.exists(file_path):
-        file_age = time.time() - os.path.getmtime(file_path)
-        return file_age > max_age_hours * 3600
-    return True
-
-def scrape(url, use_emojis=True, verbose=False) -> List:
-    ### Make a GET request and capture response, or use a cached file
-    # Encapsulate the data in each day
-    Weather = namedtuple('Weather', ['descr', 'date', 'temp_low', 'temp_high'])
-    # Fetch or read HTML content
-    location_id = url.split("/")[-1]  # Extract last part of the URL
-    html_file = f"{location_id}.html"
-    output_file = f"{os.path.join(tempfile.gettempdir(), html_file)}"
-    if is_file_outdated(output_file):
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(output_file, "w", encoding="utf-8") as file:
-                file.write(response.text)
-            if verbose:
-                print(f"HTML content saved to {output_file}")
-    elif verbose:
-        print(f"Using cached file: {output_file}")
-    with open(output_file, "r", encoding="utf-8") as file:
-        html_content = file.read()
-
-    ### Parse the relevant tags for the next 2 weeks
-    soup = BeautifulSoup(html_content, 'html.parser')
-    daily_data = []
-    ndays = 14 # that's how much BBC typically forecasts for
-    # TODO: at night it should be (1, ndays) or we have a missing high temp
-    for day in range(0, ndays):
-        day_id = f"daylink-{day}"
-        extract_numbers = lambda x: [int(xx) for xx in re.findall(r'\d+', x)]
-        try:
-            date = datetime.now() + timedelta(days=day)
-            descr, temp_low, temp_high = 'N/A', 'N/A', 'N/A'
-            # Everything is under the <a> with `day_id`
-            a_tag = soup.find('a', id=day_id)
-            if not a_tag:
-                continue
-            # There will be one short weather description
-            weather_descriptions = a_tag.find('div', class_="wr-day__details__weather-type-description")
-            if weather_descriptions:
-                descr = weather_descriptions.text.strip()
-            # Extract the temperatures - there will always be two spans (low and high)
-            temperature_spans = a_tag.find_all('span', class_="wr-value--temperature--c")
-            if temperature_spans:
-                temp_high = extract_numbers(temperature_spans[0].text.strip())[0]
-                temp_low = extract_numbers(temperature_spans[1].text.strip())[0]
-                if temp_high < temp_low:
-                    temp_low, temp_high = temp_high, temp_low
-        except Exception as e:
-            if verbose:
-                print(f"Error processing '{day_id}': {e}")
-            descr, temp_low, temp_high = 'N/A', 'N/A', 'N/A'
-            descr = a_tag.find('div', class_='wr-day__details__weather-type-description').text.strip()
-            # When it's late in the evening the <a> with id=dailink-0 is skipped
-            temps = a_tag.find_all('span', class_='wr-value--temperature--c')
-            if not temps:
-                continue
-            elif len(temps) == 1:
-                temp_low = extract_numbers(temps[0].text.strip())[0]
-            elif len(temps) == 2:
-                temp_low = extract_numbers(temps[0].text.strip())[0]
-                temp_high = extract_numbers(temps[1].text.strip())[1]
-        if use_emojis:
-            descr = f"{get_weather_emoji(descr)} {descr}"
-        daily_data.append(Weather(descr, f"{date.strftime('%a, %d %b %Y')}", temp_low, temp_high))
-    return daily_data
-
-
-def get_city_id(city_name, file_path='city_ids.dat') -> int:
-    """
-    Find the best match for a city name and return its ID from the city_id.dat file.
-    
-    Parameters:
-    - city_name (str): The city name to search for.
-    - file_path (str): The path to the file containing city names and IDs.
-    
-    Returns:
-    - int: (city_id) if a match is found, else raise an error.
-    """
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-    
-    city_data = {}
-    for line in lines:
-        # entries have format "City Name: ID: lat, lon" or "City Name: ID"
-        parts = line.strip().split(':', 2)
-        if len(parts) >= 2:
-            city = parts[0].strip()
-            city_id = int(parts[1].strip())  # This will handle ID even if coordinates follow
-            city_data[city] = city_id
-    
-    city_names = list(city_data.keys())
-    best_match = get_close_matches(city_name, city_names, n=1, cutoff=0.3)
-    
-    if best_match:
-        matched_city = best_match[0]
-        return city_data[matched_city]
-    
-    raise KeyError(f"ERROR: No such city '{city_name}' in file {file_path}.\n"
-        "Please look up the city name on bbc.com/weather and update your .dat file.")
 
 def on_press(key):
     global icard
@@ -277,31 +121,119 @@ def on_press(key):
         elif key.char == 'f' or key.char == 'x':
             print_hourly = not print_hourly
             if print_hourly:
-                os.system("cls" if os.name == "nt" else "clear")
-                print(fmt_day_hourly(city_id, days_from_now=icard))
+                with span('hourly_view'):
+                    clear_screen()
+                    print(fmt_day_hourly(city_id, days_from_now=icard))
         elif key.char == 'q':
             running = False
+        redraw.set()
     except AttributeError:
         pass
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        cities = []
-        with open('city_ids.dat') as f:
-            for line in f.readlines():
-                cities.append(line.split(':')[0])
-        city_name = find_closest_city(cities)[0]
+    parser = argparse.ArgumentParser(description="BBC weather forecast as cards on the terminal")
+    parser.add_argument('city', nargs='*', help="city name, fuzzy matched against city_ids.dat "
+                        "(default: closest city to your location)")
+    parser.add_argument('--batch', metavar='FILE', help="print the daily forecast of every city "
+                        "(name or BBC id, one per line) in FILE and exit")
+    parser.add_argument('--concurrency', type=int, default=8, help="cities fetched at once with --batch/--export")
+    parser.add_argument('--workers', type=int, nargs='?', const=0, default=None, metavar='N',
+                        help="parse the --batch/--export payloads in N processes (default: one per core)")
+    parser.add_argument('--export', metavar='FILE', help="stream the daily and hourly forecasts of every city "
+                        "(name or BBC id, one per line) in FILE as NDJSON or CSV and exit")
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson', help="--export format")
+    parser.add_argument('--output', default='-', help="--export to this file instead of stdout")
+    parser.add_argument('--gzip', action='store_true', help="gzip the --export output (implied by a .gz --output)")
+    parser.add_argument('--watch', metavar='FILE', help="keep the cached forecasts of the cities in FILE "
+                        "(name or BBC id, one per line) fresh until interrupted")
+    parser.add_argument('--once', '--print', action='store_true', help="print the daily cards once and exit, "
+                        "without the keyboard controls (e.g. for cron jobs or a shell prompt)")
+    parser.add_argument('--profile', nargs='?', const='', metavar='TRACE.json',
+                        help="time each stage and count cache hits, print a summary at exit "
+                        "and optionally write a Chrome trace (chrome://tracing) to TRACE.json")
+    args = parser.parse_args()
+    if args.profile is not None:
+        import atexit
+        import transport
+
+        def print_latencies():
+            table = transport.summary()
+            if table:
+                print(table, file=sys.stderr)
+        # atexit runs the last registered first, this goes after the summary
+        atexit.register(print_latencies)
+        profiling.enable(args.profile or None)
+    if args.once or args.batch or args.export:
+        # these exit as soon as they've printed, a stale forecast refreshed in
+        # the background would never be saved: revalidate it before using it
+        cache.stale_while_revalidate = False
+    # --workers alone means one per core
+    workers = 0 if args.workers is None else args.workers or os.cpu_count() or 1
+    if args.batch:
+        from batch import print_batch
+        print_batch(args.batch, args.concurrency, workers)
+        sys.exit(0)
+    if args.export:
+        from export import export_file
+        export_file(args.export, args.output, args.format, args.gzip, args.concurrency, workers=workers)
+        sys.exit(0)
+    if args.watch:
+        from batch import read_city_list
+        from scheduler import RefreshScheduler
+        try:
+            RefreshScheduler(read_city_list(args.watch), verbose=True).run_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if not args.city:
+        from closest_city import find_closest_city
+        with span('closest_city'):
+            city_name = find_closest_city(CityRegistry.load().names())[0]
     else:
-        if sys.argv[1] == '-h' or sys.argv[1] == '--help':
-            raise ValueError("Usage: python <this_script.py> <your_city_name>")
-        city_name = "".join(sys.argv[1:])
-    listener = keyboard.Listener(on_press=on_press)
-    listener_thread = threading.Thread(target=listener.start, daemon=True)
-    listener_thread.start()
-
-    city_id = get_city_id(city_name)
-    city_name = id2city(city_id)
-    data = scrape(f"https://www.bbc.com/weather/{city_id}")
+        city_name = "".join(args.city)
+    if not args.once:
+        from pynput import keyboard
+        listener = keyboard.Listener(on_press=on_press)
+        listener_thread = threading.Thread(target=listener.start, daemon=True)
+        listener_thread.start()
+
+    with span('city_lookup'):
+        city_id = get_city_id(city_name)
+        city_name = id2city(city_id)
+    with span('get_daily'):
+        data = get_daily(city_id)
+    if args.once:
+        print("\n".join(CardRenderer(city_name, data).lines()))
+        sys.exit(0 if data else 1)
+    from scheduler import RefreshScheduler
+    # so that switching to the hourly view doesn't block the keyboard listener
+    prefetch_hourly(city_id)
+    # refresh the forecast before it expires, the loop below picks it up
+    RefreshScheduler([city_id]).start()
+    renderer = CardRenderer(city_name, data, format_keys())
+    with span('first_frame'):
+        renderer.draw(icard)
+    full_redraw = False
     while running:
-        print_weather_cards(data)
-        time.sleep(0.2)
+        # wake up on a keypress, or now and then to pick up refreshed data
+        pressed = redraw.wait(timeout=DATA_REFRESH_SEC)
+        redraw.clear()
+        if not running:
+            break
+        if print_hourly:
+            # the hourly view is on the screen now
+            full_redraw = True
+            continue
+        if not pressed:
+            with span('get_daily'):
+                new_data = get_daily(city_id)
+            if new_data == data:
+                continue
+            data = new_data
+            renderer.set_data(city_name, data)
+        if full_redraw:
+            renderer.draw(icard)
+            full_redraw = False
+        else:
+            renderer.update(icard)
+    print()
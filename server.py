@@ -0,0 +1,184 @@
+'''
+Headless forecast service: the daily and hourly forecasts as JSON over HTTP,
+for dashboards and scripts that don't want the interactive cards.
+
+    GET /daily/{city_id}            daily forecasts
+    GET /hourly/{city_id}           dates with hourly reports
+    GET /hourly/{city_id}/{date}    hourly reports of a date (YYYY-MM-DD) and
+                                    the same text the interactive view shows
+    GET /stats                      upstream latency percentiles by host
+
+Forecasts come from the same caches as the rest of the app. Clients asking
+for the same city at the same time share one upstream fetch and parse.
+'''
+from batch import fetch_city
+from cache import cache
+import daily
+from export import daily_rows, hourly_rows
+import hourly
+import transport
+from transport import make_session
+
+import argparse
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+DEFAULT_PORT = 8080
+# connections waiting to be accepted, the default of 5 refuses bursts of clients
+REQUEST_QUEUE_SIZE = 256
+# keep-alive connections to BBC shared by all the handler threads
+UPSTREAM_CONNECTIONS = 16
+# idle keep-alive connections are closed after this long, each one holds a thread
+IDLE_TIMEOUT_SEC = 20
+
+ROUTES = [
+    ('daily', re.compile(r'^/daily/(\d+)/?$')),
+    ('dates', re.compile(r'^/hourly/(\d+)/?$')),
+    ('hourly', re.compile(r'^/hourly/(\d+)/(\d{4}-\d{2}-\d{2})/?$')),
+]
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls: while a call for a key is running, other
+    threads asking for the same key wait for it and get its result (or its
+    exception) instead of making their own.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # calls answered by another thread's call
+        self.shared = 0
+
+    def do(self, key, fn: Callable, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def _fields(rows) -> List[Dict]:
+    '''The `export` rows without what the response says once for all of them.'''
+    return [{name: value for name, value in row.items() if name not in ('city_id', 'kind')} for row in rows]
+
+
+class ForecastServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, address, verbose=False):
+        super().__init__(address, ForecastHandler)
+        self.verbose = verbose
+        self.session = make_session(UPSTREAM_CONNECTIONS)
+        self.flights = SingleFlight()
+
+    def forecast(self, city_id):
+        '''Daily and hourly forecast of a city, one fetch for all the concurrent requests.'''
+        # plain descriptions, an API has no use for the icons
+        return self.flights.do(city_id, fetch_city, city_id, self.session, False)
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    # keep-alive, so polling clients don't reconnect every time
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT_SEC
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.rstrip('/') == '/stats':
+            return self.send_json(200, {'upstream': transport.latency_percentiles()})
+        for route, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            return self.send_json(404, {'error': f"Unknown path {path}"})
+        city_id = int(match.group(1))
+        try:
+            forecast = self.server.forecast(city_id)
+        except Exception as e:
+            return self.send_json(502, {'error': f"Failed to fetch city {city_id}: {e}"})
+        if route == 'daily':
+            if not forecast.daily:
+                return self.send_json(502, {'error': f"No daily forecast for city {city_id}"})
+            return self.send_json(200, {'city_id': city_id, 'days': _fields(daily_rows(forecast))})
+        if not forecast.hourly:
+            return self.send_json(502, {'error': f"No hourly forecast for city {city_id}"})
+        if route == 'dates':
+            return self.send_json(200, {'city_id': city_id, 'dates': sorted(forecast.hourly)})
+        date = match.group(2)
+        if date not in forecast.hourly:
+            return self.send_json(404, {'error': f"No hourly forecast for city {city_id} on {date}"})
+        self.send_json(200, {'city_id': city_id, 'date': date,
+                             'reports': _fields(hourly_rows(forecast, [date])),
+                             'text': hourly.fmt_hourly_reports(forecast.hourly, date)})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, verbose=False):
+    server = ForecastServer((host, port), verbose)
+    print(f"Serving forecasts on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BBC weather forecasts as JSON over HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    # to run against a local stub instead of BBC
+    parser.add_argument('--api-url', help=f"aggregated API URL with {{}} for the city id (default: {hourly.API_URL})")
+    parser.add_argument('--page-url', help=f"daily page URL with {{}} for the city id (default: {daily.PAGE_URL})")
+    parser.add_argument('--cache-dir', help=f"cache directory (default: {cache.directory})")
+    args = parser.parse_args()
+    if args.api_url:
+        hourly.API_URL = args.api_url
+    if args.page_url:
+        daily.PAGE_URL = args.page_url
+    if args.cache_dir:
+        cache.directory = args.cache_dir
+    serve(args.host, args.port, args.verbose)
@@ -0,0 +1,199 @@
+'''
+The one way this app talks HTTP. Every request goes through `get`:
+
+- over a keep-alive `requests.Session` (one shared by default, or e.g. a
+  batch's own from `make_session`),
+- with connect and read timeouts, so a hung server can't hang the cards,
+- retried a few times with exponential backoff on connection errors and
+  429/5xx responses (not on read timeouts, a server that doesn't answer in
+  READ_TIMEOUT_SEC won't answer on the next try either),
+- asking for gzip (and brotli, if the brotli package is installed),
+- through a per-host circuit breaker: after a run of failures the host is
+  left alone for a while and `get` fails straight away, so the cache serves
+  what it has instead of every caller waiting for timeouts.
+
+The latency of every request is recorded per host, see `latency_percentiles`.
+requests is only imported once something is downloaded.
+'''
+from profiling import count
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+CONNECT_TIMEOUT_SEC = 3.05
+READ_TIMEOUT_SEC = 10
+# retries after the first attempt, waiting BACKOFF_SEC * 2 ** (n - 1) before the nth
+RETRIES = 2
+BACKOFF_SEC = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# longest a Retry-After header makes us wait before retrying
+MAX_RETRY_AFTER_SEC = 2
+# consecutive failures that open a host's circuit, and how long it stays open
+BREAKER_FAILURES = 5
+BREAKER_RESET_SEC = 60
+# latencies kept per host for the percentiles
+LATENCY_SAMPLES = 1000
+PERCENTILES = (50, 90, 99)
+DEFAULT_POOL_SIZE = 8
+
+
+class CircuitOpenError(ConnectionError):
+    '''Raised instead of a request to a host whose circuit is open.'''
+
+
+class CircuitBreaker:
+    '''
+    Closed: requests go through and consecutive failures are counted. After
+    `failures` of them it opens and refuses requests for `reset` seconds,
+    then lets a single trial request through (half-open): it closes again
+    if that one succeeds and reopens if not.
+    '''
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET_SEC):
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._trial = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.max_failures:
+                if self.opened_at is None or self._trial:
+                    count('http.circuit_opened')
+                self.opened_at, self._trial = time.monotonic(), False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[str, deque] = {}
+_lock = threading.Lock()
+_session = None
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    '''
+    Session keeping up to `pool_size` keep-alive connections per host, so
+    parallel fetches don't redo the TCP/TLS handshake, and retrying failed
+    requests with backoff.
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.request import ACCEPT_ENCODING
+    from urllib3.util.retry import Retry
+
+    class CappedRetry(Retry):
+        def get_retry_after(self, response):
+            retry_after = super().get_retry_after(response)
+            return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER_SEC)
+
+    retry = CappedRetry(total=RETRIES, connect=RETRIES, read=0, status=RETRIES, backoff_factor=BACKOFF_SEC,
+                        status_forcelist=RETRY_STATUSES, allowed_methods=['GET'], raise_on_status=False)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # urllib3's list has br when a brotli package is there to decode it
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def shared_session():
+    '''The session used when a request isn't given one.'''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+def breaker(host) -> CircuitBreaker:
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+def _record_latency(host, seconds):
+    with _lock:
+        if host not in _latencies:
+            _latencies[host] = deque(maxlen=LATENCY_SAMPLES)
+        _latencies[host].append(seconds)
+
+
+def get(url, headers=None, session=None, timeout=None):
+    '''
+    GET `url` and return the `requests.Response`. Raises what requests
+    raises once the retries are used up, or CircuitOpenError without trying
+    if the host has been failing. `timeout` is (connect, read) seconds.
+    '''
+    host = urlsplit(url).netloc
+    circuit = breaker(host)
+    if not circuit.allow():
+        count('http.circuit_rejected')
+        raise CircuitOpenError(f"{host} is failing, not trying again for a while")
+    start = time.perf_counter()
+    try:
+        response = (session or shared_session()).get(
+            url, headers=headers, timeout=timeout or (CONNECT_TIMEOUT_SEC, READ_TIMEOUT_SEC))
+    except Exception:
+        circuit.failure()
+        raise
+    finally:
+        _record_latency(host, time.perf_counter() - start)
+    if response.status_code in RETRY_STATUSES:
+        circuit.failure()
+    else:
+        circuit.success()
+    return response
+
+
+def latency_percentiles(host=None) -> Dict[str, Dict]:
+    '''
+    Request latencies in milliseconds by host: the `PERCENTILES` of the
+    last `LATENCY_SAMPLES` requests, how many requests that is and the state
+    of the host's circuit. Only `host` if given.
+    '''
+    with _lock:
+        samples = {h: sorted(s) for h, s in _latencies.items() if host is None or h == host}
+    stats = {}
+    for h, times in samples.items():
+        stats[h] = {f"p{p}": times[min(len(times) - 1, len(times) * p // 100)] * 1e3 for p in PERCENTILES}
+        stats[h]['requests'] = len(times)
+        stats[h]['circuit'] = breaker(h).state
+    return stats
+
+
+def summary() -> Optional[str]:
+    '''Latency percentiles as a table, None if nothing was requested.'''
+    stats = latency_percentiles()
+    if not stats:
+        return None
+    lines = [f"{'host':<40} {'requests':>8} " + ' '.join(f"{f'p{p} (ms)':>10}" for p in PERCENTILES)
+             + f" {'circuit':>9}"]
+    for host, s in sorted(stats.items()):
+        lines.append(f"{host:<40} {s['requests']:>8} " + ' '.join(f"{s[f'p{p}']:>10.1f}" for p in PERCENTILES)
+                     + f" {s['circuit']:>9}")
+    return "\n".join(lines)
@@ -0,0 +1,63 @@
+'''
+The icon shown next to a weather description, for the daily cards and the
+hourly reports alike. A description is split into lowercase words once and
+the rules below look at which keywords are among them, in order; the first
+that applies wins. BBC only uses a few dozen descriptions, so each one is
+classified once and remembered.
+'''
+import re
+from functools import lru_cache
+from typing import Iterable, List
+
+UNKNOWN = '?'
+_WORDS = re.compile(r'\w+')
+# the keywords are whole words, except these which also match longer words
+# starting with them: "sunny", "cloudy", "rainy"...
+PREFIXES = ('sun', 'cloud', 'rain')
+KEYWORDS = frozenset(('thunder', 'lightning', 'rain', 'storm', 'snow', 'mist', 'fog', 'drizzle', 'sleet',
+                      'clear'))
+# (icon, keyword sets that must all be present): a set is present if any of its
+# keywords is, a prefix stands for any word starting with it
+RULES = [
+    ('🌤', [{'sun*'}, {'cloud*'}]),
+    ('⛆', [{'cloud*'}, {'rain*'}]),
+    ('⛈', [{'thunder', 'lightning'}, {'rain', 'storm'}]),
+    ('🌩', [{'thunder', 'lightning'}]),
+    ('❄', [{'snow'}]),
+    ('🌫', [{'mist', 'fog'}]),
+    ('☁', [{'cloud*'}]),
+    ('⛆', [{'rain', 'drizzle'}]),
+    ('❅', [{'sleet'}]),
+    ('☀', [{'sun*', 'clear'}]),
+]
+
+
+def _keywords(description: str) -> set:
+    found = set()
+    for word in _WORDS.findall(description.lower()):
+        if word in KEYWORDS:
+            found.add(word)
+        for prefix in PREFIXES:
+            if word.startswith(prefix):
+                found.add(prefix + '*')
+    return found
+
+
+@lru_cache(maxsize=1024)
+def get_weather_emoji(description: str) -> str:
+    found = _keywords(description)
+    for icon, required in RULES:
+        if all(found & alternatives for alternatives in required):
+            return icon
+    return UNKNOWN
+
+
+def get_weather_emojis(descriptions: Iterable[str]) -> List[str]:
+    '''Icons of many descriptions, e.g. a whole column, classifying each distinct one once.'''
+    icons = {}
+    result = []
+    for description in descriptions:
+        if description not in icons:
+            icons[description] = get_weather_emoji(description)
+        result.append(icons[description])
+    return result